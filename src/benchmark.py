@@ -0,0 +1,365 @@
+"""Benchmark suite for the simulator and environment hot paths.
+
+Times Veh.move, TrafficSim.check_traffic, check_collision and update_simulation, and
+Rlagent.get_state and step, for both vehicle engines at fixed car counts. Also times a
+RoadNetwork tick against the size of the grid, off-peak traffic with the array and event
+engines, after checking that the two match tick for tick under heavy traffic, a VecEnv step of TrafficVecEnv and the QueueVecEnv queue model against the number
+of envs, PPO training steps/s and batched policy inference against the batch size. Every
+timing reports throughput and per-call latency percentiles. The results can be saved as JSON to
+compare versions or plot scaling against the number of cars.
+
+Run from src/: python benchmark.py [--output results.json] [--quick] [--no-ppo] [--no-inference]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+import numpy as np
+from config import *
+from traffic_sim import TrafficSim
+from road_network import RoadNetwork
+from demand import Demand, PoissonDemand
+
+CAR_COUNTS = [10, 50, 100, 200, 400, 800]
+# Fresh populations timed per car count, and consecutive calls timed on each
+REPEATS = 20
+TICKS = 10
+GRID_SIZES = [1, 5, 10, 20]
+# Ticks run before timing a grid, for its roads to fill up
+WARMUP_TICKS = 3000
+PPO_TIMESTEPS = 4096
+# Simulated off-peak traffic, in seconds, and its arrival rate per approach in cars/s
+OFFPEAK_SECONDS = 600
+OFFPEAK_RATE = 0.02
+# Heavy arrivals, in cars/s per approach, for checking that the event engine matches the
+# array engine across the demand's block boundaries
+CHECK_RATE = 6.0
+CHECK_SECONDS = 100
+VEC_SIZES = [1, 16, 256, 1024]
+BATCH_SIZES = [1, 4, 16, 64, 256, 1024, 4096]
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models", "traffic_agent.zip")
+ENGINES = ("object", "array")
+PERCENTILES = [50, 90, 99]
+
+
+def populate(sim: TrafficSim, num_cars: int) -> None:
+    """Spreads num_cars evenly over the four lanes. Horizontal cars fill their whole lane,
+    vertical ones queue up to their stop line, as with the lights set in prepare.
+    """
+    for direction in DIRECTIONS:
+        lane_cars = num_cars // 4 + (direction < num_cars % 4)
+        if lane_cars == 0:
+            continue
+        if direction % 2 == 0:
+            length = WIDTH - CAR_RADIUS
+        else:
+            dx, dy = DIRECTION_STEP[direction]
+            x, y = SPAWN_POS[direction]
+            length = STOP_LINE[direction] - (dx * x + dy * y)
+        spacing = length / lane_cars
+        # Furthest along first, as the lanes are ordered
+        for i in reversed(range(lane_cars)):
+            sim.add_car(direction, int(i * spacing))
+
+
+def prepare(sim: TrafficSim, num_cars: int) -> None:
+    """Resets sim to num_cars cars with the vertical approaches red, the horizontal ones
+    green, and no spawning, so nothing collides or gets added while timing
+    """
+    sim.reset()
+    populate(sim, num_cars)
+    sim.traffic_lights.update(top=0, bottom=0, left=1, right=1)
+    sim.demand = Demand()
+
+
+def summarize(samples: list[int]) -> dict:
+    """Throughput and latency statistics in microseconds of per-call times in nanoseconds"""
+    latencies = np.array(samples) / 1e3
+    summary = {"calls": len(samples), "mean_us": float(latencies.mean())}
+    for q, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+        summary[f"p{q}_us"] = float(value)
+    summary["max_us"] = float(latencies.max())
+    summary["calls_per_s"] = 1e6 / summary["mean_us"]
+    return summary
+
+
+def time_calls(setup, call, repeats: int = REPEATS, ticks: int = TICKS) -> dict:
+    """Times ticks consecutive calls of call after each of repeats calls of setup"""
+    samples = []
+    for _ in range(repeats):
+        setup()
+        for _ in range(ticks):
+            start = time.perf_counter_ns()
+            call()
+            samples.append(time.perf_counter_ns() - start)
+    return summarize(samples)
+
+
+def time_veh_move(sim: TrafficSim, num_cars: int, repeats: int = REPEATS, ticks: int = TICKS) -> dict:
+    """Times each Veh.move call of the object engine's lane sweep separately"""
+    samples = []
+    for _ in range(repeats):
+        prepare(sim, num_cars)
+        for _ in range(ticks):
+            sim.check_traffic()
+            for lane in sim.lanes:
+                leader = None
+                previous = None
+                for car in lane:
+                    if previous is not None and (previous.x, previous.y) != (car.x, car.y):
+                        leader = previous
+                    start = time.perf_counter_ns()
+                    car.move(leader)
+                    samples.append(time.perf_counter_ns() - start)
+                    previous = car
+    return summarize(samples)
+
+
+def sim_benchmarks(sim: TrafficSim) -> dict:
+    """The TrafficSim calls to time, by name"""
+    if sim.engine == "array":
+        check_traffic = lambda: sim.car_array.check_traffic(sim.traffic_lights)
+    else:
+        check_traffic = sim.check_traffic
+    return {
+        "TrafficSim.check_traffic": check_traffic,
+        "TrafficSim.check_collision": sim.check_collision,
+        "TrafficSim.update_simulation": sim.update_simulation,
+    }
+
+
+def run_sim(car_counts: list[int], repeats: int, ticks: int) -> list[dict]:
+    """Times the simulator and Rlagent calls for both engines at each car count"""
+    from rlagent import Rlagent
+
+    results = []
+    for engine in ENGINES:
+        sim = TrafficSim(engine=engine)
+        agent = Rlagent(TrafficSim(engine=engine))
+        agent.reset(seed=0)
+        # Long episodes, so timing never hits the time limit reset
+        agent.episode_length = float("inf")
+        for num_cars in car_counts:
+            timings = {}
+            if engine == "object":
+                timings["Veh.move"] = time_veh_move(sim, num_cars, repeats, ticks)
+            for name, call in sim_benchmarks(sim).items():
+                timings[name] = time_calls(lambda: prepare(sim, num_cars), call, repeats, ticks)
+            setup = lambda: prepare(agent.trafficsim, num_cars)
+            timings["Rlagent.get_state"] = time_calls(setup, agent.get_state, repeats, ticks)
+            # Action 2 keeps the lights set by prepare
+            timings["Rlagent.step"] = time_calls(setup, lambda: agent.step(2), repeats, ticks)
+            for name, summary in timings.items():
+                results.append({"benchmark": name, "engine": engine, "cars": num_cars, **summary})
+    return results
+
+
+def run_network(grid_sizes: list[int], calls: int) -> list[dict]:
+    """Times single ticks of size x size grids with random lights, once their roads have
+    filled up
+    """
+    results = []
+    for size in grid_sizes:
+        network = RoadNetwork(size, size, seed=0)
+        for tick in range(WARMUP_TICKS):
+            if tick % 60 == 0:
+                network.set_actions(network.np_random.integers(0, 4, size=network.num_intersections))
+            network.update_simulation()
+        summary = time_calls(lambda: None, network.update_simulation, 1, calls)
+        results.append({"benchmark": "RoadNetwork.update_simulation", "grid": size, "cars": len(network), **summary})
+    return results
+
+
+def run_offpeak(seconds: int) -> list[dict]:
+    """Wall time to simulate seconds of sparse traffic, lights alternating every 30 s, with
+    the array engine ticking through it and the event engine jumping between events
+    """
+    results = []
+    for engine in ("array", "event"):
+        sim = TrafficSim(engine=engine, demand=PoissonDemand([OFFPEAK_RATE] * 4))
+        sim.reset(seed=0)
+        phase_ticks = round(30 / TICK_DURATION)
+        start = time.perf_counter()
+        for phase in range(max(1, round(seconds / 30))):
+            sim.traffic_lights.update(top=phase % 2, bottom=phase % 2, left=1 - phase % 2, right=1 - phase % 2)
+            sim.advance(phase_ticks)
+        elapsed = time.perf_counter() - start
+        results.append({"benchmark": "TrafficSim.advance", "engine": engine, "simulated_s": sim.sim_time,
+                        "wall_s": elapsed, "ticks_per_s": sim.ticks / elapsed})
+    return results
+
+
+def check_event_engine(seconds: int = CHECK_SECONDS, rate: float = CHECK_RATE, seed: int = 1) -> int:
+    """Runs the array and event engines side by side under heavy Poisson demand, lights
+    alternating every 5 s, and raises if their cars differ after any phase. The run spans
+    several of the demand's blocks, where arrivals pushed past a block meet the next one.
+    Returns the ticks compared.
+    """
+    sims = [TrafficSim(engine=engine, demand=PoissonDemand([rate] * 4, seed=seed)) for engine in ("array", "event")]
+    phase_ticks = round(5 / TICK_DURATION)
+    fields = ["x", "y", "direction", "speed", "passed_intersection", "stops"]
+    for sim in sims:
+        sim.reset(seed=seed)
+    for phase in range(max(1, round(seconds / 5))):
+        states = []
+        for sim in sims:
+            sim.traffic_lights.update(top=phase % 2, bottom=phase % 2, left=1 - phase % 2, right=1 - phase % 2)
+            sim.advance(phase_ticks)
+            states.append(sim.snapshot().cars[fields])
+        if len(states[0]) != len(states[1]) or not np.array_equal(states[0], states[1]):
+            raise RuntimeError(f"event engine diverged from the array engine by tick {sims[0].ticks}")
+    return sims[0].ticks
+
+
+def run_vec_envs(vec_sizes: list[int], calls: int) -> list[dict]:
+    """Times single steps of TrafficVecEnv and QueueVecEnv with random actions, once their
+    roads have filled up
+    """
+    from vec_env import TrafficVecEnv, QueueVecEnv
+
+    results = []
+    for num_envs in vec_sizes:
+        for cls in (TrafficVecEnv, QueueVecEnv):
+            env = cls(num_envs, seed=0)
+            env.reset()
+            rng = np.random.default_rng(0)
+            actions = rng.integers(0, 4, size=num_envs)
+            for tick in range(WARMUP_TICKS // 10):
+                if tick % 60 == 0:
+                    actions = rng.integers(0, 4, size=num_envs)
+                env.step(actions)
+            summary = time_calls(lambda: None, lambda: env.step(actions), 1, calls)
+            summary["env_steps_per_s"] = summary["calls_per_s"] * num_envs
+            results.append({"benchmark": f"{cls.__name__}.step", "envs": num_envs, **summary})
+    return results
+
+
+def run_ppo(timesteps: int) -> list[dict]:
+    """PPO training throughput on a single headless Rlagent, a TrafficVecEnv and a
+    QueueVecEnv
+    """
+    from stable_baselines3 import PPO
+    from rlagent import Rlagent
+    from vec_env import TrafficVecEnv, QueueVecEnv
+
+    envs = {"Rlagent": lambda: Rlagent(TrafficSim()), "TrafficVecEnv(8)": lambda: TrafficVecEnv(8, seed=0),
+            "QueueVecEnv(8)": lambda: QueueVecEnv(8, seed=0)}
+    results = []
+    for name, make_env in envs.items():
+        model = PPO("MlpPolicy", make_env(), n_steps=512, batch_size=64, verbose=0, seed=0)
+        start = time.perf_counter()
+        model.learn(total_timesteps=timesteps)
+        seconds = time.perf_counter() - start
+        results.append({"benchmark": "PPO.learn", "env": name, "timesteps": model.num_timesteps,
+                        "steps_per_s": model.num_timesteps / seconds})
+    return results
+
+
+def run_inference(batch_sizes: list[int], calls: int, model_path: str = MODEL_PATH) -> list[dict]:
+    """Latency of one batched action prediction against the batch size, for the SB3 PPO
+    model and for the InferenceEngine in eager and TorchScript mode
+    """
+    import warnings
+    from stable_baselines3 import PPO
+    from inference import InferenceEngine
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        model = PPO.load(model_path, device="cpu")
+        predictors = {
+            "PPO.predict": lambda observations: model.predict(observations, deterministic=True),
+            "InferenceEngine eager": InferenceEngine.load(model_path, torchscript=False).predict,
+            "InferenceEngine script": InferenceEngine.load(model_path).predict,
+        }
+    rng = np.random.default_rng(0)
+    results = []
+    for batch_size in batch_sizes:
+        observations = np.concatenate([rng.integers(0, 40, size=(batch_size, 4)), rng.uniform(0, 30, size=(batch_size, 1)),
+                                       rng.integers(0, 16, size=(batch_size, 1))], axis=1)
+        for name, predict in predictors.items():
+            summary = time_calls(lambda: None, lambda: predict(observations), 1, calls)
+            summary["observations_per_s"] = summary["calls_per_s"] * batch_size
+            results.append({"benchmark": name, "batch": batch_size, **summary})
+    return results
+
+
+def metadata(args) -> dict:
+    """What the results were measured on, to tell runs apart when comparing them"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "car_counts": args.car_counts,
+        "repeats": args.repeats,
+        "ticks": args.ticks,
+    }
+
+
+def print_table(results: list[dict], key: str) -> None:
+    print(f"{'benchmark':<30} {'engine':>7} {key:>6} {'mean us':>10} {'p50 us':>10} {'p99 us':>10} {'calls/s':>12}")
+    for r in results:
+        print(f"{r['benchmark']:<30} {r.get('engine', ''):>7} {r[key]:>6} {r['mean_us']:>10.1f} "
+              f"{r['p50_us']:>10.1f} {r['p99_us']:>10.1f} {r['calls_per_s']:>12.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--car-counts", type=int, nargs="+", default=CAR_COUNTS)
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--ticks", type=int, default=TICKS)
+    parser.add_argument("--grid-sizes", type=int, nargs="+", default=GRID_SIZES)
+    parser.add_argument("--offpeak-seconds", type=int, default=OFFPEAK_SECONDS)
+    parser.add_argument("--vec-sizes", type=int, nargs="+", default=VEC_SIZES)
+    parser.add_argument("--ppo-timesteps", type=int, default=PPO_TIMESTEPS)
+    parser.add_argument("--no-ppo", action="store_true", help="skip the PPO training benchmark")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=BATCH_SIZES)
+    parser.add_argument("--no-inference", action="store_true", help="skip the policy inference benchmark")
+    parser.add_argument("--quick", action="store_true", help="fewer car counts, repeats and grid sizes")
+    args = parser.parse_args()
+    if args.quick:
+        args.car_counts = [10, 100, 400]
+        args.repeats = 5
+        args.grid_sizes = [1, 5]
+        args.offpeak_seconds = 120
+        args.vec_sizes = [1, 256]
+        args.ppo_timesteps = 1024
+        args.batch_sizes = [1, 64, 4096]
+
+    report = {"metadata": metadata(args)}
+    report["simulator"] = run_sim(args.car_counts, args.repeats, args.ticks)
+    print_table(report["simulator"], "cars")
+    report["network"] = run_network(args.grid_sizes, args.repeats * args.ticks)
+    print_table(report["network"], "grid")
+    print(f"Event engine matches the array engine over {check_event_engine()} ticks")
+    report["offpeak"] = run_offpeak(args.offpeak_seconds)
+    for r in report["offpeak"]:
+        print(f"{r['benchmark']} {r['engine']}: {r['simulated_s']:.0f} simulated s in {r['wall_s']:.2f} s")
+    report["vec_env"] = run_vec_envs(args.vec_sizes, args.repeats * args.ticks)
+    print_table(report["vec_env"], "envs")
+    if not args.no_ppo:
+        report["ppo"] = run_ppo(args.ppo_timesteps)
+        for r in report["ppo"]:
+            print(f"{r['benchmark']} {r['env']}: {r['steps_per_s']:.0f} steps/s")
+    if not args.no_inference:
+        report["inference"] = run_inference(args.batch_sizes, args.repeats * args.ticks)
+        print_table(report["inference"], "batch")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
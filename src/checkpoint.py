@@ -0,0 +1,128 @@
+"""Versioned, resumable training checkpoints written off the training thread.
+
+A checkpoint is a directory checkpoint_<iteration> holding the SB3 model zip, which
+includes the optimizer state and step counters, and a state.pkl with the training loop's
+counters and the Python, NumPy and torch RNG states, plus that of the Demand spawning the
+training env's cars if given. The model is serialized to memory
+on the training thread, so the snapshot is consistent, and only the disk writes run on a
+background thread. Checkpoints are written under a temporary name and renamed when
+complete, so a crash mid-write never leaves a checkpoint that resume would pick up.
+"""
+import io
+import os
+import pickle
+import random
+import re
+import shutil
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+import torch
+from stable_baselines3 import PPO
+
+VERSION = 1
+CHECKPOINT_PATTERN = re.compile(r"checkpoint_(\d+)")
+
+
+def rng_state(demand=None) -> dict:
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if demand is not None:
+        state["demand"] = demand.rng.bit_generator.state
+    return state
+
+
+def set_rng_state(state: dict, demand=None) -> None:
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if demand is not None and "demand" in state:
+        demand.rng.bit_generator.state = state["demand"]
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Writes data to path through a temporary file, so readers never see a partial file"""
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+class CheckpointManager:
+    """Saves numbered checkpoints of a PPO model to directory, keeping the newest keep"""
+    def __init__(self, directory: str = "./models/checkpoints", keep: int = 5):
+        if keep < 1:
+            raise ValueError("keep must be at least 1")
+        self.directory = directory
+        self.keep = keep
+        # One writer, so checkpoints land in order and retention sees every one
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        self.pending = None
+
+    def checkpoints(self) -> list[tuple[int, str]]:
+        """(iteration, path) of every complete checkpoint, oldest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        found = []
+        for name in os.listdir(self.directory):
+            match = CHECKPOINT_PATTERN.fullmatch(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(self.directory, name)))
+        return sorted(found)
+
+    def latest(self) -> str | None:
+        checkpoints = self.checkpoints()
+        return checkpoints[-1][1] if checkpoints else None
+
+    def save(self, model: PPO, iteration: int, counters: dict | None = None, export_path: str | None = None,
+             exclude: list[str] | None = None, demand=None) -> Future:
+        """Snapshots model, the RNG states and counters, and writes them as the checkpoint
+        of iteration in the background. With export_path, the model zip is also written
+        there. exclude names model attributes not to save, as in PPO.save. With demand,
+        its Generator's state is saved too. Waits for the previous checkpoint first, so at
+        most one is in flight.
+        """
+        buffer = io.BytesIO()
+        model.save(buffer, exclude=exclude)
+        state = {"version": VERSION, "iteration": iteration, "counters": counters or {}, "rng": rng_state(demand)}
+        self.wait()
+        self.pending = self.executor.submit(self.write, iteration, buffer.getvalue(), pickle.dumps(state), export_path)
+        return self.pending
+
+    def write(self, iteration: int, model_data: bytes, state_data: bytes, export_path: str | None) -> str:
+        path = os.path.join(self.directory, f"checkpoint_{iteration:06d}")
+        partial = path + ".partial"
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        write_atomic(os.path.join(partial, "model.zip"), model_data)
+        write_atomic(os.path.join(partial, "state.pkl"), state_data)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(partial, path)
+        if export_path:
+            os.makedirs(os.path.dirname(export_path) or ".", exist_ok=True)
+            write_atomic(export_path, model_data)
+        for _, old in self.checkpoints()[:-self.keep]:
+            shutil.rmtree(old, ignore_errors=True)
+        return path
+
+    def wait(self) -> None:
+        """Blocks until the checkpoint in flight is written, raising its error if it failed"""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def load(self, path: str, env=None, demand=None, **kwargs) -> tuple[PPO, dict]:
+        """Loads the checkpoint at path, restoring the RNG states, including demand's if
+        given and saved. Returns the model, bound to env, and the checkpoint's iteration
+        and counters.
+        """
+        with open(os.path.join(path, "state.pkl"), "rb") as f:
+            state = pickle.load(f)
+        if state["version"] != VERSION:
+            raise ValueError(f"Unsupported checkpoint version: {state['version']}")
+        model = PPO.load(os.path.join(path, "model.zip"), env=env, **kwargs)
+        set_rng_state(state["rng"], demand)
+        return model, {"iteration": state["iteration"], **state["counters"]}
+
+    def close(self) -> None:
+        self.wait()
+        self.executor.shutdown()
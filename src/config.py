@@ -29,7 +29,30 @@ CAR_SPEED = 2
 CAR_RADIUS = 10
 CAR_SPAWN_RATE = 0.1
 
+# Per-direction lane geometry, indexed by direction. Lines are given as progress along the
+# direction of travel: x for 0 (left to right), -y for 1 (bottom to top), -x for 2 (right
+# to left) and y for 3 (top to bottom).
+LIGHT_KEYS = ["left", "bottom", "right", "top"]
+SPAWN_POS = [(0, HEIGHT // 2 + LANE_WIDTH // 2), (WIDTH // 2 + LANE_WIDTH // 2, HEIGHT),
+             (WIDTH, HEIGHT // 2 - LANE_WIDTH // 2), (WIDTH // 2 - LANE_WIDTH // 2, 0)]
+DIRECTION_STEP = [(1, 0), (0, -1), (-1, 0), (0, 1)]
+# A red light holds cars past the stop line that have not passed the intersection
+STOP_LINE = [LIGHT_LEFT_X, -LIGHT_BOTTOM_Y, -LIGHT_RIGHT_X, LIGHT_TOP_Y]
+# Cars moving on a green light pass the intersection at this line
+PASS_LINE = [LIGHT_BOTTOM_X + 3, -LIGHT_BOTTOM_Y + 3, -LIGHT_RIGHT_X + 3, LIGHT_TOP_Y + 3]
+# Cars past this line have left the screen
+EXIT_LINE = [WIDTH, 0, 0, HEIGHT]
+# The box where the two roads overlap. Lanes in opposite directions are a full lane
+# apart, so cars from different directions can only touch when both are inside it.
+CONFLICT_START = [WIDTH // 2 - ROAD_WIDTH // 2, -HEIGHT // 2 - ROAD_WIDTH // 2,
+                  -WIDTH // 2 - ROAD_WIDTH // 2, HEIGHT // 2 - ROAD_WIDTH // 2]
+CONFLICT_END = [WIDTH // 2 + ROAD_WIDTH // 2, -HEIGHT // 2 + ROAD_WIDTH // 2,
+                -WIDTH // 2 + ROAD_WIDTH // 2, HEIGHT // 2 + ROAD_WIDTH // 2]
+
 FPS = 120
+# Simulated seconds per tick. All timing (spawns, light debounce, waiting time, episode
+# length) runs on this clock, so dynamics do not depend on how fast ticks are computed.
+TICK_DURATION = 1 / FPS
 
 # Colors
 WHITE = (255, 255, 255)
@@ -0,0 +1,192 @@
+"""Arrival schedules for TrafficSim.
+
+A Demand generates the arrivals of a whole block of ticks at once, vectorized, from its
+own numpy Generator, and the tick loop only pops the arrivals due. Directions are the
+approaches cars enter from, in DIRECTIONS order, the same order as LIGHT_KEYS. Cars
+entering one approach are spaced at least min_headway_ticks apart, so they never spawn on
+top of each other; an arrival that would be too close waits at the entry instead.
+
+Count files are CSV files with a seconds column, holding the start of each counting
+interval, and one column per approach named after LIGHT_KEYS, holding the cars that
+entered during the interval. The last interval is as long as the one before it.
+"""
+import math
+import numpy as np
+from config import *
+
+# Cars closer than this are stopped behind their leader, see Veh.move
+MIN_HEADWAY_TICKS = math.ceil(2 * CAR_RADIUS / CAR_SPEED)
+
+
+class Demand:
+    """Base class of the arrival generators, which on its own schedules no cars.
+
+    Subclasses implement schedule. Ticks must be asked for in increasing order, as the
+    simulator does, and reset starts the schedule over from tick 0.
+    """
+    def __init__(self, seed: int | None = None, horizon_seconds: float = 20.0, min_headway_ticks: int = MIN_HEADWAY_TICKS):
+        self.rng = np.random.default_rng(seed)
+        self.horizon = max(1, round(horizon_seconds / TICK_DURATION))
+        self.min_headway_ticks = min_headway_ticks
+        self.reset()
+
+    def reset(self, seed: int | None = None) -> None:
+        """Restarts the schedule at tick 0, drawn from a new Generator seeded with seed if
+        given and from where the current one left off otherwise
+        """
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+        self.block_end = 0
+        self.arrival_ticks = []
+        self.arrival_directions = []
+        self.cursor = 0
+        # Latest entry tick per approach, carried across blocks for the headway
+        self.last_entry = [-self.min_headway_ticks] * len(DIRECTIONS)
+
+    def schedule(self, start: int, stop: int) -> tuple[np.ndarray, np.ndarray]:
+        """Arrival ticks in [start, stop) and their directions, sorted by tick"""
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    def next_block(self) -> None:
+        start, stop = self.block_end, self.block_end + self.horizon
+        ticks, directions = self.schedule(start, stop)
+        ticks, directions = self.space(ticks, directions)
+        # Arrivals pushed past the block by the headway are kept, in tick order
+        order = np.argsort(ticks, kind="stable")
+        self.arrival_ticks = ticks[order].tolist()
+        self.arrival_directions = directions[order].tolist()
+        self.cursor = 0
+        self.block_end = stop
+
+    def space(self, ticks: np.ndarray, directions: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Delays arrivals so each approach's entries are at least min_headway_ticks
+        apart: entry i is the larger of arrival i and entry i - 1 plus the headway, which
+        unrolls to a running maximum
+        """
+        h = self.min_headway_ticks
+        entries = ticks.copy()
+        for direction in DIRECTIONS:
+            selected = np.flatnonzero(directions == direction)
+            if len(selected) == 0:
+                continue
+            steps = h * np.arange(1, len(selected) + 1)
+            earliest = np.maximum.accumulate(np.maximum(ticks[selected] - steps, self.last_entry[direction]))
+            entries[selected] = earliest + steps
+            self.last_entry[direction] = int(entries[selected[-1]])
+        return entries, directions
+
+    def extend(self) -> None:
+        """Moves on to the next block, keeping the arrivals not yet due"""
+        # Arrivals delayed past the end of the block come first in the next one
+        late = list(zip(self.arrival_ticks[self.cursor:], self.arrival_directions[self.cursor:]))
+        self.next_block()
+        if late:
+            merged = sorted(late + list(zip(self.arrival_ticks, self.arrival_directions)), key=lambda a: a[0])
+            self.arrival_ticks = [t for t, _ in merged]
+            self.arrival_directions = [d for _, d in merged]
+
+    def next_arrival(self, limit: int) -> int:
+        """Tick of the next arrival not yet due, or limit if there is none before it"""
+        # Arrivals pushed past the block by the headway may come after the next block's
+        # first ones, so the next block is merged in before one of them is returned
+        while self.block_end < limit and (self.cursor == len(self.arrival_ticks)
+                                          or self.arrival_ticks[self.cursor] >= self.block_end):
+            self.extend()
+        if self.cursor < len(self.arrival_ticks):
+            return min(self.arrival_ticks[self.cursor], limit)
+        return limit
+
+    def due(self, tick: int) -> list[int]:
+        """Directions of the cars entering at tick"""
+        while tick >= self.block_end:
+            self.extend()
+        start = self.cursor
+        end = start
+        ticks = self.arrival_ticks
+        while end < len(ticks) and ticks[end] <= tick:
+            end += 1
+        self.cursor = end
+        return self.arrival_directions[start:end]
+
+    def state(self) -> tuple:
+        """Everything the arrivals still to come depend on, for TrafficSim.snapshot. The
+        schedule lists are replaced, never modified, so they are shared rather than copied.
+        """
+        return (self.rng.bit_generator.state, self.block_end, self.arrival_ticks, self.arrival_directions,
+                self.cursor, tuple(self.last_entry))
+
+    def set_state(self, state: tuple) -> None:
+        generator_state, self.block_end, self.arrival_ticks, self.arrival_directions, self.cursor, last_entry = state
+        self.rng.bit_generator.state = generator_state
+        self.last_entry = list(last_entry)
+
+
+class UniformDemand(Demand):
+    """One car every interval_seconds on a uniformly random approach, the simulator's
+    original spawning
+    """
+    def __init__(self, interval_seconds: float = CAR_SPAWN_RATE, **kwargs):
+        self.interval = round(interval_seconds / TICK_DURATION)
+        super().__init__(**kwargs)
+
+    def schedule(self, start: int, stop: int) -> tuple[np.ndarray, np.ndarray]:
+        first = max(self.interval, -(-start // self.interval) * self.interval)
+        ticks = np.arange(first, stop, self.interval, dtype=np.int64)
+        return ticks, self.rng.integers(0, len(DIRECTIONS), size=len(ticks))
+
+
+class PoissonDemand(Demand):
+    """Independent Poisson arrivals per approach.
+
+    rates are in cars per second, either one per approach or, for demand that varies over
+    time, an array of shape (periods, 4) whose rows apply for period_seconds each in turn,
+    repeating after the last.
+    """
+    def __init__(self, rates, period_seconds: float = 60.0, **kwargs):
+        self.rates = np.atleast_2d(np.asarray(rates, dtype=np.float64))
+        if self.rates.shape[1] != len(DIRECTIONS):
+            raise ValueError(f"Expected a rate per approach, got shape {self.rates.shape}")
+        self.period = max(1, round(period_seconds / TICK_DURATION))
+        super().__init__(**kwargs)
+
+    def schedule(self, start: int, stop: int) -> tuple[np.ndarray, np.ndarray]:
+        ticks = np.arange(start, stop)
+        rates = self.rates[(ticks // self.period) % len(self.rates)]
+        counts = self.rng.poisson(rates * TICK_DURATION)
+        rows, directions = np.nonzero(counts)
+        repeats = counts[rows, directions]
+        return np.repeat(ticks[rows], repeats), np.repeat(directions, repeats)
+
+
+class CountDemand(Demand):
+    """Replays recorded counts: each interval gets exactly its counted cars per approach,
+    at uniformly random ticks within it. The counts repeat after the last interval.
+    """
+    def __init__(self, starts, counts, **kwargs):
+        starts = np.asarray(starts, dtype=np.float64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        if self.counts.shape != (len(starts), len(DIRECTIONS)):
+            raise ValueError(f"Expected one count per interval and approach, got shape {self.counts.shape}")
+        if len(starts) > 1 and np.any(np.diff(starts) <= 0):
+            raise ValueError("Interval starts must increase")
+        last = starts[-1] - starts[-2] if len(starts) > 1 else 60.0
+        bounds = np.append(starts - starts[0], starts[-1] - starts[0] + last)
+        self.bounds = np.round(bounds / TICK_DURATION).astype(np.int64)
+        # A block is one pass through the counts
+        kwargs["horizon_seconds"] = self.bounds[-1] * TICK_DURATION
+        super().__init__(**kwargs)
+
+    @classmethod
+    def from_csv(cls, path: str, **kwargs) -> 'CountDemand':
+        data = np.genfromtxt(path, delimiter=",", names=True)
+        counts = np.stack([data[key] for key in LIGHT_KEYS], axis=-1)
+        return cls(np.atleast_1d(data["seconds"]), np.atleast_2d(counts), **kwargs)
+
+    def schedule(self, start: int, stop: int) -> tuple[np.ndarray, np.ndarray]:
+        intervals, directions = np.nonzero(self.counts)
+        repeats = self.counts[intervals, directions]
+        intervals, directions = np.repeat(intervals, repeats), np.repeat(directions, repeats)
+        lengths = self.bounds[intervals + 1] - self.bounds[intervals]
+        ticks = start + self.bounds[intervals] + (self.rng.random(len(intervals)) * lengths).astype(np.int64)
+        order = np.argsort(ticks, kind="stable")
+        return ticks[order], directions[order]
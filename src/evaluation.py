@@ -0,0 +1,95 @@
+"""Policy evaluation in a separate process, in parallel with training.
+
+The learner submits a snapshot of its policy weights every so often and carries on. A
+worker process loads each snapshot into its own copy of the policy and runs
+evaluate_policy on its own headless Rlagent, so the training env's episodes are never
+disturbed and evaluation can use many episodes without slowing training.
+"""
+import multiprocessing as mp
+import queue
+import signal
+import time
+from stable_baselines3 import PPO
+from stable_baselines3.common.evaluation import evaluate_policy
+from stable_baselines3.common.vec_env import DummyVecEnv
+
+
+def evaluation_worker(requests, results, n_eval_episodes: int, seed: int, decision_interval: int, policy_kwargs: dict | None) -> None:
+    """Evaluates each (iteration, state_dict) read from requests until it reads None"""
+    # Ctrl+C reaches the whole process group. The learner stops this worker itself, after
+    # saving its checkpoint.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from rlagent import Rlagent
+    from traffic_sim import TrafficSim
+
+    env = DummyVecEnv([lambda: Rlagent(TrafficSim(), decision_interval=decision_interval)])
+    model = PPO("MlpPolicy", env, policy_kwargs=policy_kwargs, verbose=0)
+    while (request := requests.get()) is not None:
+        iteration, state_dict = request
+        start = time.perf_counter()
+        model.policy.load_state_dict(state_dict)
+        # Every snapshot sees the same traffic, so their rewards are comparable
+        env.seed(seed)
+        mean_reward, std_reward = evaluate_policy(model.policy, env, n_eval_episodes=n_eval_episodes)
+        results.put({"iteration": iteration, "mean_reward": float(mean_reward), "std_reward": float(std_reward),
+                     "episodes": n_eval_episodes, "seconds": time.perf_counter() - start})
+
+
+class AsyncEvaluator:
+    """Evaluates policy snapshots in a worker process.
+
+    submit never blocks: a snapshot is dropped if the worker already has one running and
+    one waiting, so a slow evaluation cannot build up a backlog. Results are collected
+    with poll as they arrive.
+    """
+    def __init__(self, n_eval_episodes: int = 10, seed: int = 0, decision_interval: int = 1, policy_kwargs: dict | None = None):
+        methods = mp.get_all_start_methods()
+        # As in SubprocVecEnv: forking a process that runs torch threads is unsafe
+        context = mp.get_context("forkserver" if "forkserver" in methods else "spawn")
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(target=evaluation_worker, daemon=True, name="evaluator",
+                                       args=(self.requests, self.results, n_eval_episodes, seed, decision_interval, policy_kwargs))
+        self.process.start()
+        self.in_flight = 0
+
+    def submit(self, iteration: int, policy) -> bool:
+        """Queues a copy of policy's current weights for evaluation. Returns False if the
+        snapshot was dropped because the worker is behind.
+        """
+        if self.in_flight >= 2:
+            return False
+        # The queue pickles on a feeder thread, after training may have changed the weights
+        state_dict = {name: tensor.detach().cpu().clone() for name, tensor in policy.state_dict().items()}
+        self.requests.put((iteration, state_dict))
+        self.in_flight += 1
+        return True
+
+    def poll(self, timeout: float | None = None) -> list[dict]:
+        """Results that have arrived, waiting up to timeout seconds for the first one if
+        given
+        """
+        results = []
+        try:
+            if timeout is not None and self.in_flight:
+                results.append(self.results.get(timeout=timeout))
+            while True:
+                results.append(self.results.get_nowait())
+        except queue.Empty:
+            pass
+        self.in_flight -= len(results)
+        return results
+
+    def close(self, wait: bool = True) -> list[dict]:
+        """Stops the worker. With wait, snapshots already submitted are evaluated first and
+        their results returned.
+        """
+        results = []
+        if wait:
+            while self.in_flight and self.process.is_alive():
+                results += self.poll(timeout=1.0)
+        self.requests.put(None)
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        return results
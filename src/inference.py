@@ -0,0 +1,127 @@
+"""Serving-side policy inference for deployed signal controllers.
+
+Loads the actor of a trained PPO policy from its policy.pth, either inside the saved
+models/traffic_agent.zip or on its own, and picks the deterministic action of many
+intersections in one forward pass. Only NumPy and PyTorch are needed: no Stable-Baselines3,
+Gymnasium or simulator. The actor can be exported to TorchScript, and loaded back from it,
+or to ONNX for other runtimes.
+"""
+import io
+import os
+import re
+import zipfile
+import numpy as np
+import torch
+from torch import nn
+
+
+class PolicyNet(nn.Module):
+    """The actor half of SB3's MlpPolicy: the policy MLP with tanh activations followed by
+    the action head, returning the action logits
+    """
+    def __init__(self, layer_sizes: list[int], num_actions: int = 4):
+        super().__init__()
+        self.observation_size = layer_sizes[0]
+        layers = []
+        for size_in, size_out in zip(layer_sizes[:-1], layer_sizes[1:]):
+            layers += [nn.Linear(size_in, size_out), nn.Tanh()]
+        self.policy_net = nn.Sequential(*layers)
+        self.action_net = nn.Linear(layer_sizes[-1], num_actions)
+
+    def forward(self, observations: torch.Tensor) -> torch.Tensor:
+        return self.action_net(self.policy_net(observations))
+
+    @classmethod
+    def from_state_dict(cls, state_dict: dict) -> 'PolicyNet':
+        """Builds the actor from the state dict of a saved SB3 policy, ignoring the value
+        network
+        """
+        indices = sorted(int(match.group(1)) for key in state_dict
+                         if (match := re.fullmatch(r"mlp_extractor\.policy_net\.(\d+)\.weight", key)))
+        weights = [state_dict[f"mlp_extractor.policy_net.{i}.weight"] for i in indices]
+        net = cls([weights[0].shape[1]] + [weight.shape[0] for weight in weights], state_dict["action_net.weight"].shape[0])
+        actor = {}
+        for position, i in enumerate(indices):
+            for name in ("weight", "bias"):
+                actor[f"policy_net.{2 * position}.{name}"] = state_dict[f"mlp_extractor.policy_net.{i}.{name}"]
+        for name in ("weight", "bias"):
+            actor[f"action_net.{name}"] = state_dict[f"action_net.{name}"]
+        net.load_state_dict(actor)
+        return net
+
+
+def load_state_dict(path: str) -> dict:
+    """Reads policy.pth from a saved model zip, from a directory holding it or from the
+    file itself
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            data = io.BytesIO(archive.read("policy.pth"))
+        return torch.load(data, map_location="cpu", weights_only=True)
+    if os.path.isdir(path):
+        path = os.path.join(path, "policy.pth")
+    return torch.load(path, map_location="cpu", weights_only=True)
+
+
+class InferenceEngine:
+    """Batched deterministic actions from a trained policy.
+
+    predict takes the observations of any number of intersections, laid out like
+    Rlagent.get_state, as an array of shape (N, 6) and returns their N actions. Several
+    engines can share one process: torch threads are only set when num_threads is given.
+    """
+    def __init__(self, net: nn.Module, num_threads: int | None = None):
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.net = net.eval()
+        self.warmup()
+
+    def warmup(self, calls: int = 3) -> None:
+        """Runs a few forward passes, so the TorchScript optimizer has specialized the
+        graph before the first real request
+        """
+        observations = torch.zeros(1, self.net.observation_size)
+        with torch.inference_mode():
+            for _ in range(calls):
+                self.net(observations)
+
+    @classmethod
+    def load(cls, path: str = "models/traffic_agent.zip", torchscript: bool = True, **kwargs) -> 'InferenceEngine':
+        """Loads the actor of a saved policy, compiled to TorchScript unless torchscript is
+        False
+        """
+        net = PolicyNet.from_state_dict(load_state_dict(path))
+        if torchscript:
+            net = torch.jit.script(net)
+        return cls(net, **kwargs)
+
+    @classmethod
+    def load_torchscript(cls, path: str, **kwargs) -> 'InferenceEngine':
+        """Loads an actor saved by export_torchscript"""
+        return cls(torch.jit.load(path, map_location="cpu"), **kwargs)
+
+    def export_torchscript(self, path: str) -> None:
+        net = self.net if isinstance(self.net, torch.jit.ScriptModule) else torch.jit.script(self.net)
+        net.save(path)
+
+    def export_onnx(self, path: str) -> None:
+        """Writes the actor as an ONNX graph with a dynamic batch dimension, taking float32
+        observations and returning logits. Needs the onnx package.
+        """
+        net = self.net
+        if isinstance(net, torch.jit.ScriptModule):
+            raise ValueError("export to ONNX from an engine loaded with torchscript=False")
+        torch.onnx.export(net, (torch.zeros(1, net.observation_size),), path, dynamo=False,
+                          input_names=["observations"], output_names=["logits"],
+                          dynamic_axes={"observations": {0: "batch"}, "logits": {0: "batch"}})
+
+    def predict(self, observations: np.ndarray) -> np.ndarray:
+        """Actions of a batch of observations of shape (N, 6), or of a single one of shape
+        (6,)
+        """
+        observations = np.asarray(observations, dtype=np.float32)
+        single = observations.ndim == 1
+        with torch.inference_mode():
+            logits = self.net(torch.from_numpy(observations.reshape(-1, observations.shape[-1])))
+        actions = logits.argmax(dim=1).numpy()
+        return actions[0] if single else actions
@@ -0,0 +1,368 @@
+"""Streaming traffic performance metrics for long simulated runs.
+
+A MetricsCollector is fed every car that leaves the screen and the queue lengths after
+every tick, and keeps only counters and quantile sketches, so its memory stays the same
+however long the run. Every interval it writes one summary row per approach, plus one
+pooled over all approaches, to a CSV file, or to a Parquet file if the path ends in
+.parquet and pyarrow is installed.
+
+A car's delay is the time it spent stopped, at a red light or behind another car. Cars
+only ever move at CAR_SPEED, so this is the time it lost against driving straight
+through. Its waiting time is the part spent held by a red light, as in the observation.
+A queue is the stopped cars of an approach that have not passed the intersection.
+
+Run from src/: python metrics.py [--seconds 3600] [--interval 300] [--output metrics/]
+"""
+import argparse
+import csv
+import math
+import os
+import numpy as np
+from config import *
+
+QUANTILES = (0.5, 0.9, 0.99)
+# Summarized metrics that only take whole values, whose quantiles are rounded to them
+COUNTS = ("stops", "queue")
+SUMMARY_COLUMNS = (
+    ["start_seconds", "end_seconds", "approach", "vehicles", "throughput_per_hour"]
+    + [f"delay_{name}" for name in ("mean", "p50", "p90", "p99", "max")]
+    + [f"waiting_{name}" for name in ("mean", "p90")]
+    + [f"stops_{name}" for name in ("mean", "p90", "max")]
+    + [f"queue_{name}" for name in ("mean", "p50", "p90", "p99", "max")]
+)
+
+
+class QuantileSketch:
+    """Streaming quantiles of non-negative values with a bounded relative error, in the
+    manner of DDSketch.
+
+    Values are counted in bins whose bounds grow geometrically by gamma, so any quantile
+    is returned within relative_accuracy of a value of the right rank. Zeros are counted
+    on their own. Once there are more than max_bins bins the lowest ones are merged,
+    which only costs accuracy on the smallest values, so memory is bounded whatever the
+    number of values added. The count, sum, min and max are exact.
+    """
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        # Bin index to weight. Bin i holds the values in (gamma^(i-1), gamma^i].
+        self.bins = {}
+        self.zeros = 0.0
+        self.count = 0.0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def __len__(self) -> int:
+        return len(self.bins)
+
+    def add(self, value: float, weight: float = 1.0) -> None:
+        self.count += weight
+        self.sum += value * weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if value <= 0:
+            self.zeros += weight
+            return
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.bins[index] = self.bins.get(index, 0.0) + weight
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def add_many(self, values: np.ndarray, weights: np.ndarray | None = None) -> None:
+        """Vectorized add of every value, with weight 1 or the matching weight"""
+        values = np.asarray(values, dtype=np.float64)
+        weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=np.float64)
+        present = weights > 0
+        values, weights = values[present], weights[present]
+        if len(values) == 0:
+            return
+        self.count += weights.sum()
+        self.sum += values @ weights
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        positive = values > 0
+        self.zeros += weights[~positive].sum()
+        indices = np.ceil(np.log(values[positive]) / self._log_gamma).astype(np.int64)
+        unique, inverse = np.unique(indices, return_inverse=True)
+        totals = np.bincount(inverse, weights=weights[positive], minlength=len(unique))
+        bins = self.bins
+        for index, weight in zip(unique.tolist(), totals.tolist()):
+            bins[index] = bins.get(index, 0.0) + weight
+        if len(bins) > self.max_bins:
+            self._collapse()
+
+    def merge(self, other: "QuantileSketch") -> None:
+        """Adds every value of other, which must have the same relative accuracy"""
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches of different relative accuracies")
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.sum += other.sum
+        self.zeros += other.zeros
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for index, weight in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0.0) + weight
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self) -> None:
+        """Merges the lowest bins into one until there are max_bins left"""
+        indices = sorted(self.bins)
+        excess = len(indices) - self.max_bins + 1
+        self.bins[indices[excess]] += sum(self.bins.pop(index) for index in indices[:excess])
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else math.nan
+
+    def quantile(self, q: float) -> float:
+        """Value of rank q in [0, 1], NaN when nothing was added"""
+        if self.count == 0:
+            return math.nan
+        rank = q * (self.count - 1)
+        if rank < self.zeros:
+            return max(self.min, 0.0)
+        total = self.zeros
+        for index in sorted(self.bins):
+            total += self.bins[index]
+            if total > rank:
+                break
+        # The middle of the bin in relative terms
+        value = 2 * self.gamma ** index / (self.gamma + 1)
+        return min(max(value, self.min), self.max)
+
+
+class ApproachStats:
+    """The cars that left and the queue lengths of one approach over some ticks"""
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.vehicles = 0
+        self.delay = QuantileSketch(relative_accuracy)
+        self.waiting = QuantileSketch(relative_accuracy)
+        self.stops = QuantileSketch(relative_accuracy)
+        self.queue = QuantileSketch(relative_accuracy)
+
+    def merge(self, other: "ApproachStats") -> None:
+        self.vehicles += other.vehicles
+        self.delay.merge(other.delay)
+        self.waiting.merge(other.waiting)
+        self.stops.merge(other.stops)
+        self.queue.merge(other.queue)
+
+    def row(self, start_seconds: float, end_seconds: float, approach: str) -> dict:
+        """Summary row in SUMMARY_COLUMNS, delays and waiting times in seconds"""
+        hours = (end_seconds - start_seconds) / 3600
+        row = {"start_seconds": round(start_seconds, 6), "end_seconds": round(end_seconds, 6),
+               "approach": approach, "vehicles": self.vehicles,
+               "throughput_per_hour": self.vehicles / hours if hours > 0 else math.nan}
+        for name, sketch in (("delay", self.delay), ("waiting", self.waiting),
+                             ("stops", self.stops), ("queue", self.queue)):
+            row[f"{name}_mean"] = float(sketch.mean)
+            row[f"{name}_max"] = float(sketch.max) if sketch.count else math.nan
+            for q in QUANTILES:
+                value = sketch.quantile(q)
+                row[f"{name}_p{round(q * 100)}"] = float(round(value) if name in COUNTS and value == value else value)
+        return {column: row[column] for column in SUMMARY_COLUMNS}
+
+
+class CsvSummaryWriter:
+    """Appends summary rows to a CSV file, flushed after every write so an interrupted run
+    keeps every interval written so far
+    """
+    def __init__(self, path: str):
+        self.file = open(path, "w", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=SUMMARY_COLUMNS)
+        self.writer.writeheader()
+
+    def write(self, rows: list[dict]) -> None:
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ParquetSummaryWriter:
+    """Appends summary rows to a Parquet file, one row group per write. Needs pyarrow."""
+    def __init__(self, path: str):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as error:
+            raise ImportError("Writing Parquet summaries needs pyarrow, or use a .csv path") from error
+        self.pa = pa
+        self.schema = pa.schema([(column, pa.string() if column == "approach" else pa.float64())
+                                 for column in SUMMARY_COLUMNS])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, rows: list[dict]) -> None:
+        columns = {column: [row[column] for row in rows] for column in SUMMARY_COLUMNS}
+        self.writer.write_table(self.pa.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+def open_summary_writer(path: str):
+    if path.endswith(".parquet"):
+        return ParquetSummaryWriter(path)
+    return CsvSummaryWriter(path)
+
+
+class MetricsCollector:
+    """Throughput, delay, waiting time and stop count distributions of the cars that
+    leave, and queue length distributions, per approach in LIGHT_KEYS order.
+
+    record_exit or record_exits is called for the cars leaving, then record_ticks once the
+    tick is over. Every interval_seconds of ticks recorded, a summary of the interval is
+    written to path, if given, and added to the totals of the whole run. TrafficSim does
+    all of this itself after start_metrics.
+    """
+    def __init__(self, path: str | None = None, interval_seconds: float = 60.0, relative_accuracy: float = 0.01):
+        self.interval_ticks = max(1, round(interval_seconds / TICK_DURATION))
+        self.relative_accuracy = relative_accuracy
+        self.writer = open_summary_writer(path) if path is not None else None
+        self.ticks = 0
+        self.window_start = 0
+        self.window = self._new_stats()
+        self.totals = self._new_stats()
+        # Ticks spent at each queue length in the current window, per approach, added to
+        # the queue sketches when the window is summarized. Plain lists, as they are
+        # updated every tick.
+        self.queue_ticks = [[0] * 16 for _ in LIGHT_KEYS]
+
+    def _new_stats(self) -> list[ApproachStats]:
+        return [ApproachStats(self.relative_accuracy) for _ in LIGHT_KEYS]
+
+    def record_exit(self, direction: int, waiting_time: float, delay_ticks: int, stops: int) -> None:
+        stats = self.window[direction]
+        stats.vehicles += 1
+        stats.delay.add(delay_ticks * TICK_DURATION)
+        stats.waiting.add(waiting_time)
+        stats.stops.add(stops)
+
+    def record_exits(self, directions: np.ndarray, waiting_times: np.ndarray, delay_ticks: np.ndarray, stops: np.ndarray) -> None:
+        """Vectorized record_exit for the cars given as arrays"""
+        for direction in np.unique(directions).tolist():
+            leaving = directions == direction
+            stats = self.window[direction]
+            stats.vehicles += int(leaving.sum())
+            stats.delay.add_many(delay_ticks[leaving] * TICK_DURATION)
+            stats.waiting.add_many(waiting_times[leaving])
+            stats.stops.add_many(stops[leaving])
+
+    def record_ticks(self, queue_lengths, ticks: int = 1) -> None:
+        """Counts ticks more ticks with the given queue length per approach, summarizing
+        every interval completed
+        """
+        while ticks > 0:
+            # A stretch of ticks can run past the end of the interval
+            counted = min(ticks, self.window_start + self.interval_ticks - self.ticks)
+            for counts, length in zip(self.queue_ticks, queue_lengths):
+                if length >= len(counts):
+                    counts.extend([0] * (length + 1 - len(counts)))
+                counts[length] += counted
+            self.ticks += counted
+            ticks -= counted
+            if self.ticks == self.window_start + self.interval_ticks:
+                self.flush()
+
+    def flush(self) -> None:
+        """Summarizes the ticks recorded since the last summary, if any"""
+        if self.ticks == self.window_start:
+            return
+        for stats, ticks in zip(self.window, self.queue_ticks):
+            stats.queue.add_many(np.arange(len(ticks)), ticks)
+        if self.writer is not None:
+            self.writer.write(self.rows(self.window, self.window_start, self.ticks))
+        for total, stats in zip(self.totals, self.window):
+            total.merge(stats)
+        self.window = self._new_stats()
+        self.queue_ticks = [[0] * len(counts) for counts in self.queue_ticks]
+        self.window_start = self.ticks
+
+    def rows(self, stats: list[ApproachStats], start: int, end: int) -> list[dict]:
+        """Summary rows of each approach's stats and of all of them pooled, over the ticks
+        from start to end
+        """
+        pooled = ApproachStats(self.relative_accuracy)
+        for approach in stats:
+            pooled.merge(approach)
+        start_seconds, end_seconds = start * TICK_DURATION, end * TICK_DURATION
+        return ([approach.row(start_seconds, end_seconds, key) for key, approach in zip(LIGHT_KEYS, stats)]
+                + [pooled.row(start_seconds, end_seconds, "all")])
+
+    def summary(self) -> list[dict]:
+        """Summary rows of the whole run so far, up to the last summarized interval"""
+        return self.rows(self.totals, 0, self.window_start)
+
+    def close(self) -> None:
+        """Summarizes the last, partial interval and closes the file"""
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def run_controller(trafficsim, controller, seconds: float, decision_interval: int = 12) -> None:
+    """Drives trafficsim for seconds simulated seconds with controller, which picks an
+    action from an Rlagent observation every decision_interval ticks, as in pretrain.py
+    """
+    observation = np.zeros(6)
+    for _ in range(round(seconds / TICK_DURATION) // decision_interval):
+        left, bottom, right, top = trafficsim.approach_counts()
+        observation[:4] = top, bottom, left, right
+        action = controller(observation)
+        vertical, horizontal = (1 if action & 1 else 0), (1 if action & 2 else 0)
+        trafficsim.traffic_lights.update(top=vertical, bottom=vertical, left=horizontal, right=horizontal)
+        trafficsim.advance(decision_interval)
+
+
+def main():
+    from pretrain import FixedTimeController, QueueActuatedController
+    from demand import UniformDemand, PoissonDemand
+    from traffic_sim import TrafficSim
+
+    parser = argparse.ArgumentParser(description="Compare signal controllers over a long simulated run")
+    parser.add_argument("--seconds", type=float, default=3600.0, help="simulated seconds per controller")
+    parser.add_argument("--interval", type=float, default=300.0, help="simulated seconds per summary row")
+    parser.add_argument("--rate", type=float, help="Poisson arrivals per second per approach instead of the default demand")
+    parser.add_argument("--decision-interval", type=int, default=12, help="ticks between controller decisions")
+    parser.add_argument("--output", help="directory to write a summary file per controller to")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    controllers = {
+        "fixed_time": FixedTimeController(decision_interval=args.decision_interval),
+        "queue_actuated": QueueActuatedController(clearance_seconds=0.5, decision_interval=args.decision_interval),
+    }
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+    print(f"{'controller':<16}{'vehicles':>10}{'veh/h':>10}{'delay':>8}{'p50':>8}{'p90':>8}{'p99':>8}"
+          f"{'stops':>8}{'queue p90':>10}")
+    for name, controller in controllers.items():
+        if args.rate is not None:
+            demand = PoissonDemand([args.rate] * len(DIRECTIONS), seed=args.seed)
+        else:
+            demand = UniformDemand(seed=args.seed)
+        trafficsim = TrafficSim(engine="event", demand=demand)
+        trafficsim.reset(seed=args.seed)
+        path = None if args.output is None else os.path.join(args.output, f"{name}.{args.format}")
+        metrics = trafficsim.start_metrics(path, args.interval)
+        run_controller(trafficsim, controller, args.seconds, args.decision_interval)
+        trafficsim.stop_metrics()
+        row = metrics.summary()[-1]
+        print(f"{name:<16}{row['vehicles']:>10}{row['throughput_per_hour']:>10.0f}{row['delay_mean']:>8.2f}"
+              f"{row['delay_p50']:>8.2f}{row['delay_p90']:>8.2f}{row['delay_p99']:>8.2f}"
+              f"{row['stops_mean']:>8.2f}{row['queue_p90']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
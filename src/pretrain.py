@@ -0,0 +1,290 @@
+"""Behaviour-cloning pretraining of the PPO policy from heuristic signal controllers.
+
+Rollouts of a cheap queue-actuated controller are generated on a headless Rlagent and
+stored, then the policy is trained to reproduce its actions, and its value head to
+predict their discounted returns. The policy only sees the observation, so the controller
+cloned must decide from the observation alone: the fixed-time controller, which follows a
+clock, is kept as a baseline to compare against.
+
+compare measures whether PPO fine-tuning a pretrained policy reaches a target reward in
+fewer timesteps than PPO from scratch. So far it does not, see the README.
+
+Run from src/: python pretrain.py [--steps 50000] [--dataset rollouts.npz] [--output models/pretrained]
+               python pretrain.py --compare [--target -300] [--max-timesteps 100000]
+"""
+import argparse
+import time
+import numpy as np
+import torch
+from torch.nn import functional as F
+from config import *
+from stable_baselines3 import PPO
+from stable_baselines3.common.evaluation import evaluate_policy
+from stable_baselines3.common.vec_env import DummyVecEnv
+from rlagent import Rlagent
+from traffic_sim import TrafficSim
+
+# Actions, as in Rlagent.step
+ALL_RED = 0
+VERTICAL_GREEN = 1
+HORIZONTAL_GREEN = 2
+
+
+class FixedTimeController:
+    """Alternates green between the two roads on a fixed cycle, with an all-red clearance
+    after each phase so the box empties before the other road gets green
+    """
+    def __init__(self, green_seconds: float = 2.0, clearance_seconds: float = 0.5, decision_interval: int = 1):
+        step_seconds = decision_interval * TICK_DURATION
+        self.green_steps = max(1, round(green_seconds / step_seconds))
+        self.clearance_steps = round(clearance_seconds / step_seconds)
+        self.reset()
+
+    def reset(self) -> None:
+        self.steps = 0
+
+    def __call__(self, observation: np.ndarray) -> int:
+        phase_steps = self.green_steps + self.clearance_steps
+        position = self.steps % (2 * phase_steps)
+        self.steps += 1
+        if position % phase_steps >= self.green_steps:
+            return ALL_RED
+        return VERTICAL_GREEN if position < phase_steps else HORIZONTAL_GREEN
+
+
+class QueueActuatedController:
+    """Gives green to the road with the longer queue. A phase is held for at least
+    min_green_seconds and, if clearance_seconds is set, followed by an all-red clearance
+    when it changes.
+    """
+    def __init__(self, min_green_seconds: float = 1.0, clearance_seconds: float = 0.0, decision_interval: int = 1):
+        step_seconds = decision_interval * TICK_DURATION
+        self.min_green_steps = max(1, round(min_green_seconds / step_seconds))
+        self.clearance_steps = round(clearance_seconds / step_seconds)
+        self.reset()
+
+    def reset(self) -> None:
+        self.green = VERTICAL_GREEN
+        self.green_steps = 0
+        self.clearance_left = 0
+
+    def __call__(self, observation: np.ndarray) -> int:
+        if self.clearance_left > 0:
+            self.clearance_left -= 1
+            return ALL_RED
+        # Observations start with the queues at the top, bottom, left and right
+        vertical = observation[0] + observation[1]
+        horizontal = observation[2] + observation[3]
+        wanted = VERTICAL_GREEN if vertical >= horizontal else HORIZONTAL_GREEN
+        if wanted != self.green and self.green_steps >= self.min_green_steps:
+            self.green = wanted
+            self.green_steps = 0
+            if self.clearance_steps > 0:
+                self.clearance_left = self.clearance_steps - 1
+                return ALL_RED
+        self.green_steps += 1
+        return self.green
+
+
+def generate_rollouts(controller, num_steps: int, seed: int = 0, decision_interval: int = 1, exploration: float = 0.3) -> dict:
+    """Runs controller on a headless Rlagent for num_steps steps. Returns the observations,
+    the controller's actions, the rewards and episode ends as arrays, plus the return of
+    each finished episode and the parameters they were generated with, see
+    rollout_parameters.
+
+    With probability exploration a step applies a random green phase instead of the
+    controller's action, which is still the one recorded. Without this the lights in the
+    observation almost always match the action, and a cloned policy learns to copy them
+    and never switches phase.
+    """
+    rng = np.random.default_rng(seed)
+    env = Rlagent(TrafficSim(), decision_interval=decision_interval)
+    observation, _ = env.reset(seed=seed)
+    controller.reset()
+    observations = np.zeros((num_steps, 6), dtype=np.float32)
+    actions = np.zeros(num_steps, dtype=np.int64)
+    rewards = np.zeros(num_steps, dtype=np.float32)
+    dones = np.zeros(num_steps, dtype=bool)
+    episode_returns = []
+    episode_return = 0.0
+    for step in range(num_steps):
+        observations[step] = observation
+        actions[step] = controller(observation)
+        action = actions[step]
+        if rng.random() < exploration:
+            action = rng.choice([VERTICAL_GREEN, HORIZONTAL_GREEN])
+        observation, rewards[step], dones[step], _, _ = env.step(action)
+        episode_return += rewards[step]
+        if dones[step]:
+            controller.reset()
+            episode_returns.append(episode_return)
+            episode_return = 0.0
+    return {"observations": observations, "actions": actions, "rewards": rewards, "dones": dones,
+            "episode_returns": np.array(episode_returns), "seed": np.array(seed),
+            "decision_interval": np.array(decision_interval), "exploration": np.array(exploration)}
+
+
+def rollout_parameters(rollouts: dict) -> tuple | None:
+    """The number of steps, seed, decision interval and exploration rollouts were
+    generated with, or None for a dataset saved without them
+    """
+    if not all(key in rollouts for key in ("seed", "decision_interval", "exploration")):
+        return None
+    return (len(rollouts["actions"]), int(rollouts["seed"]), int(rollouts["decision_interval"]),
+            float(rollouts["exploration"]))
+
+
+def save_rollouts(path: str, rollouts: dict) -> None:
+    np.savez_compressed(path, **rollouts)
+
+
+def load_rollouts(path: str) -> dict:
+    with np.load(path) as data:
+        return dict(data)
+
+
+def discounted_returns(rewards: np.ndarray, dones: np.ndarray, gamma: float) -> np.ndarray:
+    returns = np.zeros_like(rewards)
+    running = 0.0
+    for step in reversed(range(len(rewards))):
+        if dones[step]:
+            running = 0.0
+        running = rewards[step] + gamma * running
+        returns[step] = running
+    return returns
+
+
+def behaviour_clone(model: PPO, rollouts: dict, epochs: int = 10, batch_size: int = 256, value_coef: float = 0.5) -> float:
+    """Trains model's policy to take the rollouts' actions and its value head to predict
+    their discounted returns, with the policy's own optimizer. Returns the fraction of
+    the rollouts' actions the policy then picks.
+    """
+    policy = model.policy
+    device = policy.device
+    observations = torch.as_tensor(rollouts["observations"], dtype=torch.float32, device=device)
+    actions = torch.as_tensor(rollouts["actions"], device=device)
+    returns = torch.as_tensor(discounted_returns(rollouts["rewards"], rollouts["dones"], model.gamma), device=device)
+    generator = torch.Generator().manual_seed(0)
+
+    policy.set_training_mode(True)
+    for epoch in range(epochs):
+        for batch in torch.randperm(len(actions), generator=generator).split(batch_size):
+            values, log_prob, _ = policy.evaluate_actions(observations[batch], actions[batch])
+            loss = -log_prob.mean() + value_coef * F.mse_loss(values.flatten(), returns[batch])
+            policy.optimizer.zero_grad()
+            loss.backward()
+            policy.optimizer.step()
+    policy.set_training_mode(False)
+
+    with torch.no_grad():
+        predicted = policy.get_distribution(observations).distribution.probs.argmax(dim=1)
+    return float((predicted == actions).float().mean())
+
+
+def pretrain(model: PPO, num_steps: int, seed: int = 0, decision_interval: int = 1, dataset: str | None = None,
+             epochs: int = 10, exploration: float = 0.3) -> float:
+    """Behaviour-clones model from num_steps steps of the queue-actuated controller,
+    loaded from dataset if it exists and was generated with the same parameters, and
+    generated (and saved there) otherwise. Returns the policy's agreement with the
+    controller's actions.
+    """
+    try:
+        rollouts = load_rollouts(dataset) if dataset else None
+    except FileNotFoundError:
+        rollouts = None
+    if rollouts is not None and rollout_parameters(rollouts) != (num_steps, seed, decision_interval, exploration):
+        print(f"{dataset} was generated with other parameters, regenerating it")
+        rollouts = None
+    if rollouts is None:
+        controller = QueueActuatedController(decision_interval=decision_interval)
+        rollouts = generate_rollouts(controller, num_steps, seed, decision_interval, exploration)
+        if dataset:
+            save_rollouts(dataset, rollouts)
+    return behaviour_clone(model, rollouts, epochs)
+
+
+def timesteps_to_reward(model: PPO, target: float, max_timesteps: int, eval_interval: int = 4096,
+                        eval_episodes: int = 5, seed: int = 0) -> dict:
+    """Trains model with PPO, evaluating it every eval_interval timesteps on the same
+    seeded traffic, until its mean reward reaches target or max_timesteps have been
+    trained. Returns the timesteps and training seconds it took, None if the target was
+    not reached, and the (timesteps, mean reward, mean episode length) curve. Evaluation
+    time is not counted.
+    """
+    env = DummyVecEnv([lambda: Rlagent(TrafficSim())])
+    curve = []
+    timesteps = 0
+    seconds = 0.0
+    while True:
+        env.seed(seed)
+        rewards, lengths = evaluate_policy(model.policy, env, n_eval_episodes=eval_episodes, return_episode_rewards=True)
+        mean_reward = float(np.mean(rewards))
+        curve.append((timesteps, mean_reward, float(np.mean(lengths))))
+        if mean_reward >= target:
+            return {"timesteps": timesteps, "seconds": seconds, "curve": curve}
+        if timesteps >= max_timesteps:
+            return {"timesteps": None, "seconds": None, "curve": curve}
+        start = time.perf_counter()
+        model.learn(total_timesteps=eval_interval, reset_num_timesteps=False)
+        seconds += time.perf_counter() - start
+        timesteps = model.num_timesteps
+
+
+def compare(target: float, max_timesteps: int, pretrain_steps: int = 50000, seed: int = 0,
+            eval_interval: int = 4096, eval_episodes: int = 5) -> dict:
+    """Timesteps and seconds PPO takes to reach target from scratch and after pretraining
+    on pretrain_steps controller steps, see timesteps_to_reward. The pretrained run's
+    seconds include generating the rollouts and cloning them.
+    """
+    results = {}
+    for name, steps in (("scratch", 0), ("pretrained", pretrain_steps)):
+        model = PPO("MlpPolicy", Rlagent(TrafficSim()), verbose=0, seed=seed)
+        start = time.perf_counter()
+        if steps:
+            pretrain(model, steps, seed)
+        pretrain_seconds = time.perf_counter() - start
+        result = timesteps_to_reward(model, target, max_timesteps, eval_interval, eval_episodes, seed)
+        if result["seconds"] is not None:
+            result["seconds"] += pretrain_seconds
+        results[name] = result
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pretrain the PPO policy from heuristic controllers")
+    parser.add_argument("--steps", type=int, default=50000, help="rollout steps of the controller")
+    parser.add_argument("--dataset", help="load the rollouts from, or save them to, this .npz file")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="save the pretrained model here")
+    parser.add_argument("--eval-episodes", type=int, default=10)
+    parser.add_argument("--compare", action="store_true",
+                        help="measure how long PPO takes to reach --target from scratch and after pretraining")
+    parser.add_argument("--target", type=float, default=-300.0, help="mean reward to reach with --compare")
+    parser.add_argument("--max-timesteps", type=int, default=100000, help="PPO timesteps to give up after with --compare")
+    args = parser.parse_args()
+
+    if args.compare:
+        results = compare(args.target, args.max_timesteps, args.steps, args.seed, eval_episodes=args.eval_episodes)
+        for name, result in results.items():
+            curve = ", ".join(f"{timesteps}: {reward:.0f} ({length:.0f})" for timesteps, reward, length in result["curve"])
+            if result["timesteps"] is None:
+                print(f"{name}: did not reach {args.target} in {args.max_timesteps} timesteps")
+            else:
+                print(f"{name}: reached {args.target} after {result['timesteps']} timesteps, {result['seconds']:.0f}s")
+            print(f"  mean reward (episode length) by timesteps: {curve}")
+        return
+
+    env = Rlagent(TrafficSim())
+    model = PPO("MlpPolicy", env, verbose=0, seed=args.seed)
+    untrained, _ = evaluate_policy(model.policy, model.get_env(), n_eval_episodes=args.eval_episodes)
+    accuracy = pretrain(model, args.steps, args.seed, dataset=args.dataset, epochs=args.epochs)
+    pretrained, _ = evaluate_policy(model.policy, model.get_env(), n_eval_episodes=args.eval_episodes)
+    print(f"Agreement with the controller: {accuracy:.1%}")
+    print(f"Mean reward: {untrained:.1f} untrained, {pretrained:.1f} pretrained")
+    if args.output:
+        model.save(args.output)
+
+
+if __name__ == "__main__":
+    main()
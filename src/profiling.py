@@ -0,0 +1,99 @@
+import functools
+import time
+from collections import defaultdict
+from stable_baselines3.common.callbacks import BaseCallback
+
+
+class Profiler:
+    """Wall time and call counts per phase of the simulation and training loop since the
+    last reset, plus gauges such as the number of cars on screen.
+
+    Phases are collected by wrapping methods of the objects to profile, so nothing is
+    timed, and nothing costs anything, until instrument is called. Phases nest: the time
+    of a step includes the simulation, collision and observation phases it calls. A call
+    made inside another call of the same phase is not counted again.
+    """
+    def __init__(self):
+        # Cleared rather than replaced by reset, as the wrappers hold on to them
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.gauges = {}
+        self.active = set()
+        self.reset()
+
+    def reset(self) -> None:
+        self.seconds.clear()
+        self.calls.clear()
+        self.gauges.clear()
+        self.start_time = time.perf_counter()
+
+    def instrument(self, obj, method_name: str, phase: str) -> None:
+        """Replaces obj.method_name with a wrapper that adds its calls to phase"""
+        method = getattr(obj, method_name)
+        seconds = self.seconds
+        calls = self.calls
+        active = self.active
+
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            if phase in active:
+                return method(*args, **kwargs)
+            active.add(phase)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                active.discard(phase)
+                seconds[phase] += time.perf_counter() - start
+                calls[phase] += 1
+
+        setattr(obj, method_name, timed)
+
+    def gauge(self, name: str, value: float) -> None:
+        self.gauges[name] = value
+
+    def summary(self) -> dict:
+        """Flat dict of every phase's total milliseconds and calls, the gauges and the env
+        steps per second since the last reset
+        """
+        summary = {}
+        for phase, seconds in self.seconds.items():
+            summary[f"{phase}_ms"] = seconds * 1e3
+            summary[f"{phase}_calls"] = self.calls[phase]
+        summary.update(self.gauges)
+        if "step" in self.calls:
+            summary["steps_per_s"] = self.calls["step"] / (time.perf_counter() - self.start_time)
+        return summary
+
+    def report(self) -> str:
+        """One line per phase with its share of the wall time since the last reset"""
+        elapsed = time.perf_counter() - self.start_time
+        lines = [f"{'phase':<12} {'calls':>8} {'total ms':>10} {'mean us':>10} {'share':>7}"]
+        for phase, seconds in sorted(self.seconds.items(), key=lambda item: -item[1]):
+            calls = self.calls[phase]
+            lines.append(f"{phase:<12} {calls:>8} {seconds * 1e3:>10.1f} {seconds / calls * 1e6:>10.1f} {seconds / elapsed:>7.1%}")
+        for name, value in self.gauges.items():
+            lines.append(f"{name}: {value}")
+        if "step" in self.calls:
+            lines.append(f"steps/s: {self.calls['step'] / elapsed:.0f}")
+        return "\n".join(lines)
+
+
+class ProfilerCallback(BaseCallback):
+    """Records a Profiler's summary, along with the profile the first env reports in its
+    step info, to the SB3 logger under profile/ at the end of every rollout
+    """
+    def __init__(self, profiler: Profiler | None = None, verbose: int = 0):
+        super().__init__(verbose)
+        self.profiler = profiler
+
+    def _on_step(self) -> bool:
+        return True
+
+    def _on_rollout_end(self) -> None:
+        summary = self.profiler.summary() if self.profiler is not None else {}
+        infos = self.locals.get("infos") or [{}]
+        # An env in this process may share the profiler, so only add what it lacks
+        summary = {**infos[0].get("profile", {}), **summary}
+        for key, value in summary.items():
+            self.logger.record(f"profile/{key}", value)
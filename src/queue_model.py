@@ -0,0 +1,331 @@
+"""Mesoscopic queue model of the intersection, a fast stand-in for TrafficSim.
+
+Cars are not moved pixel by pixel. Each approach is a point queue at its stop line fed by
+a fixed free-flow delay from the spawn point, discharging one car per saturation headway,
+followed by the stretch up to the pass line, which cars only advance along on green, and
+the free-flow run out to the exit. Only the cars past the stop line are tracked one by
+one, by entry time, so waiting times and collisions between crossing flows still come
+out per car. Everything is stepped for many intersections at once, like TrafficVecEnv.
+
+The delays, positions and headways all follow from the lane geometry in config and the
+car-following rule of Veh.move. Cars keep a constant speed and cannot overtake, so with
+the default headway this reproduces the observations, rewards and collisions of the
+array engine tick for tick; calibrate compares the two.
+"""
+import argparse
+import numpy as np
+from config import *
+from vehicle_array import AXIS, SIGN, SPAWN_XY, STOP_P, PASS_P, EXIT_P, CONFLICT_START_P, CONFLICT_END_P, FOLLOW_DISTANCE
+
+SPAWN_P = SIGN * SPAWN_XY[np.arange(4), AXIS]
+# Moves from the spawn point to the first position past the stop line, where a red light
+# holds a car, on to the pass line, and on out of bounds
+STOP_TICKS = (STOP_P - SPAWN_P) // CAR_SPEED + 1
+ENTER_P = SPAWN_P + CAR_SPEED * STOP_TICKS
+PASS_TICKS = -(-(PASS_P - ENTER_P) // CAR_SPEED)
+LEAVE_P = ENTER_P + CAR_SPEED * PASS_TICKS
+EXIT_TICKS = (EXIT_P - LEAVE_P) // CAR_SPEED + 1
+# A stationary queue closes up to just under FOLLOW_DISTANCE and starts as one platoon,
+# so queued cars cross the stop line this many ticks apart
+SATURATION_HEADWAY = (FOLLOW_DISTANCE - 1) // CAR_SPEED
+
+
+def zone_ages(start_p: np.ndarray, ticks: np.ndarray) -> list[np.ndarray]:
+    """Per direction, the ticks into a stretch of the given length starting at start_p at
+    which a car is inside the conflict zone, a contiguous range
+    """
+    ages = []
+    for d in DIRECTIONS:
+        p = start_p[d] + CAR_SPEED * np.arange(ticks[d])
+        ages.append(np.flatnonzero((p >= CONFLICT_START_P[d]) & (p <= CONFLICT_END_P[d])))
+    return ages
+
+
+def slot_positions(start_p: np.ndarray, ages: list[np.ndarray], directions: list[int]) -> np.ndarray:
+    """(x, y) of the zone positions given by ages on the given directions, in order"""
+    positions = []
+    for d in directions:
+        xy = np.repeat(SPAWN_XY[d][None, :], len(ages[d]), axis=0)
+        xy[:, AXIS[d]] = SIGN[d] * (start_p[d] + CAR_SPEED * ages[d])
+        positions.append(xy)
+    return np.concatenate(positions)
+
+
+class QueueModel:
+    """Queues, waiting times and conflict-zone occupancy of num_envs independent
+    intersections.
+
+    Per intersection and approach, a car spawned at tick t reaches the stop line at
+    t + STOP_TICKS and joins the queue there. The head of the queue crosses the stop line,
+    whatever the light, once the car before it has moved headway ticks on. Past the line,
+    a car needs PASS_TICKS ticks of green to pass the intersection and is held on red,
+    accruing waiting time unless it is stopped right behind another held car. It then
+    runs EXIT_TICKS ticks to the exit. Queue counts and waiting totals are reported like
+    VehArray's.
+    """
+    def __init__(self, num_envs: int, headway: int = SATURATION_HEADWAY):
+        if headway < 1:
+            raise ValueError("headway must be at least one tick")
+        self.num_envs = num_envs
+        self.headway = headway
+        self.clock = 0
+        # Ring sizes: longer than any car can stay on the stretch they index
+        self.arrival_slots = int(STOP_TICKS.max()) + 1
+        self.exit_slots = int(EXIT_TICKS.max()) + 1
+        # Cars held past the stop line are at least a headway apart
+        self.hold_capacity = int(PASS_TICKS.max()) // headway + 1
+        # Per-approach state is laid out direction first, and the rings slot first, so
+        # each tick reads and writes whole rows of num_envs
+        shape = (4, num_envs)
+        self.cells = np.arange(4 * num_envs).reshape(shape)
+        # Cars reaching the stop line, by arrival clock
+        self.arrivals = np.zeros((self.arrival_slots,) + shape, dtype=np.int64)
+        # Cars spawned and not yet at the stop line, and queued at the line
+        self.approaching = np.zeros(shape, dtype=np.int64)
+        self.queued = np.zeros(shape, dtype=np.int64)
+        # Ticks of green and of red each approach has had. Held cars move on green only.
+        self.green_ticks = np.zeros(shape, dtype=np.int64)
+        self.red_ticks = np.zeros(shape, dtype=np.int64)
+        # Cars past the stop line, first in first out, as the green tick count of their
+        # approach when they crossed it and the red tick count when they started waiting,
+        # -1 while they are stopped right behind another held car. Held cars keep their
+        # gaps, so that only changes when the car in front passes.
+        self.entered = np.zeros(shape, dtype=np.int64)
+        self.passed = np.zeros(shape, dtype=np.int64)
+        self.held_green = np.zeros((self.hold_capacity,) + shape, dtype=np.int64)
+        self.held_red = np.zeros((self.hold_capacity,) + shape, dtype=np.int64)
+        self.unblocked = np.zeros(shape, dtype=np.int64)
+        # Clock when the last car passed the intersection, after which it moves every tick
+        self.last_pass = np.zeros(shape, dtype=np.int64)
+        # Cars past the intersection, by the clock when they passed it, with their waiting
+        # time
+        self.leaving = np.zeros((self.exit_slots,) + shape, dtype=bool)
+        self.leaving_waiting = np.zeros((self.exit_slots,) + shape)
+        self.waiting_totals = np.zeros(num_envs)
+        self._build_conflicts()
+        self.clear(np.ones(num_envs, dtype=bool))
+
+    def _build_conflicts(self) -> None:
+        """Lists the positions inside the conflict zone, held and leaving, and which
+        vertical and horizontal ones are closer than two car radii
+        """
+        self.held_ages = zone_ages(ENTER_P, PASS_TICKS)
+        self.leaving_ages = zone_ages(LEAVE_P, EXIT_TICKS)
+        h, v = [np.concatenate([slot_positions(ENTER_P, self.held_ages, directions),
+                                slot_positions(LEAVE_P, self.leaving_ages, directions)])
+                for directions in ([0, 2], [1, 3])]
+        distance = np.hypot(*(v[:, None, :] - h[None, :, :]).transpose(2, 0, 1))
+        self.conflicts = (distance < 2 * CAR_RADIUS).astype(np.float32)
+
+    def clear(self, envs: np.ndarray) -> None:
+        """Empties the intersections selected by the boolean mask envs"""
+        for values in (self.approaching, self.queued, self.green_ticks, self.red_ticks, self.entered, self.passed, self.unblocked):
+            values[:, envs] = 0
+        for values in (self.arrivals, self.leaving):
+            values[:, :, envs] = 0
+        self.waiting_totals[envs] = 0
+        # So the first car may cross the stop line straight away
+        self.last_pass[:, envs] = self.clock - self.headway
+
+    def spawn(self, envs: np.ndarray, directions: np.ndarray) -> None:
+        """Adds one car per (env, direction) pair at the spawn point"""
+        slots = (self.clock + STOP_TICKS[directions]) % self.arrival_slots
+        np.add.at(self.arrivals, (slots, directions, envs), 1)
+        np.add.at(self.approaching, (directions, envs), 1)
+
+    def held_counts(self) -> np.ndarray:
+        return self.entered - self.passed
+
+    def step(self, traffic_lights: np.ndarray) -> None:
+        """Advances every intersection one tick under traffic_lights, of shape
+        (num_envs, 4) in direction order
+        """
+        self.clock += 1
+        green = traffic_lights.T == 1
+        cells = self.cells
+        size = cells.size
+        capacity = self.hold_capacity
+
+        # Cars past the stop line advance on green and pass the intersection after
+        # PASS_TICKS of it. On red they are held, and wait unless the car in front is
+        # held too and closer than FOLLOW_DISTANCE, as Veh.move then has them blocked.
+        red = ~green
+        self.green_ticks += green
+        self.red_ticks += red
+        self.waiting_totals += TICK_DURATION * (self.unblocked * red).sum(axis=0)
+        front = self.passed % capacity * size + cells
+        passing = (self.entered > self.passed) & (self.green_ticks - self.held_green.take(front) == PASS_TICKS[:, None])
+        slot = self.clock % self.exit_slots
+        self.leaving[slot] = passing
+        if passing.any():
+            self.leaving_waiting[slot] = TICK_DURATION * (self.red_ticks - self.held_red.take(front))
+            self.passed += passing
+            self.unblocked -= passing
+            self.last_pass[passing] = self.clock
+            # The car behind is at the front now, and free to wait
+            front = self.passed % capacity * size + cells
+            freed = passing & (self.entered > self.passed) & (self.held_red.take(front) < 0)
+            self.held_red.put(front[freed], self.red_ticks[freed])
+            self.unblocked += freed
+
+        # Cars running out of bounds take their waiting time with them
+        slots = (self.clock - EXIT_TICKS) % self.exit_slots
+        leaving = self.leaving[slots, DIRECTIONS]
+        if leaving.any():
+            self.waiting_totals -= (leaving * self.leaving_waiting[slots, DIRECTIONS]).sum(axis=0)
+
+        # Arrivals join the queue, and its head crosses the stop line once the car ahead
+        # of it has moved a headway on: on green only while that car is held, every tick
+        # once it has passed
+        slot = self.clock % self.arrival_slots
+        arrived = self.arrivals[slot]
+        if arrived.any():
+            self.queued += arrived
+            self.approaching -= arrived
+            arrived[:] = 0
+        held = self.entered > self.passed
+        back = (self.entered - 1) % capacity * size + cells
+        moved = np.where(held, self.green_ticks - self.held_green.take(back), PASS_TICKS[:, None] + self.clock - self.last_pass)
+        entering = (self.queued > 0) & (moved >= self.headway)
+        if entering.any():
+            tail = (back[entering] + size) % (capacity * size)
+            free = (~held | (CAR_SPEED * moved >= FOLLOW_DISTANCE))[entering]
+            self.held_green.put(tail, self.green_ticks[entering])
+            self.held_red.put(tail, np.where(free, self.red_ticks[entering], -1))
+            self.entered += entering
+            self.queued -= entering
+            self.unblocked[entering] += free
+
+    def approach_counts(self) -> np.ndarray:
+        """Cars per intersection and direction that have not passed it, of shape
+        (num_envs, 4) as in VehArray
+        """
+        return (self.approaching + self.queued + self.held_counts()).T
+
+    def total_waiting_time(self) -> np.ndarray:
+        return self.waiting_totals
+
+    def zone_occupancy(self, directions: list[int]) -> np.ndarray:
+        """Whether each conflict-zone position of the given directions holds a car, of
+        shape (positions, num_envs) in the order of _build_conflicts
+        """
+        occupied = []
+        for d in directions:
+            ages = self.held_ages[d]
+            held = np.zeros((len(ages), self.num_envs), dtype=bool)
+            if len(ages):
+                rows = self.green_ticks[d] - self.held_green[:, d] - ages[0]
+                slots = (np.arange(self.hold_capacity)[:, None] - self.passed[d]) % self.hold_capacity
+                inside = (slots < self.entered[d] - self.passed[d]) & (rows >= 0) & (rows < len(ages))
+                held[rows[inside], np.nonzero(inside)[1]] = True
+            occupied.append(held)
+        for d in directions:
+            occupied.append(self.leaving[(self.clock - self.leaving_ages[d]) % self.exit_slots, d])
+        return np.concatenate(occupied)
+
+    def collided_envs(self) -> np.ndarray:
+        """Boolean mask of the intersections with a horizontal and a vertical car in the
+        conflict zone closer than two car radii
+        """
+        horizontal = self.zone_occupancy([0, 2])
+        collided = horizontal.any(axis=0)
+        if not collided.any():
+            return collided
+        # Only intersections with cars of both axes in the zone can have a collision
+        vertical = self.zone_occupancy([1, 3])
+        collided &= vertical.any(axis=0)
+        if collided.any():
+            near = self.conflicts @ horizontal[:, collided].astype(np.float32)
+            collided[collided] = (near * vertical[:, collided]).any(axis=0)
+        return collided
+
+
+# Open-loop light schedules for calibrate, as the action of every env at each tick.
+# Envs are staggered so they do not all switch at once.
+def fixed_time_actions(tick: int, num_envs: int, green_seconds: float = 2.0, clearance_seconds: float = 0.5) -> np.ndarray:
+    """Each axis green for green_seconds in turn, with all red for clearance_seconds between"""
+    green = round(green_seconds / TICK_DURATION)
+    clearance = round(clearance_seconds / TICK_DURATION)
+    phase = (tick + np.arange(num_envs) * 7) % (2 * (green + clearance))
+    return np.select([phase < green, (phase >= green + clearance) & (phase < 2 * green + clearance)], [1, 2], 0)
+
+
+def random_actions(tick: int, num_envs: int, hold_seconds: float = 0.5) -> np.ndarray:
+    """A uniformly random action per env, held for hold_seconds"""
+    hold = round(hold_seconds / TICK_DURATION)
+    return np.random.default_rng(tick // hold).integers(0, 4, size=num_envs)
+
+
+SCHEDULES = {
+    "fixed_time": fixed_time_actions,
+    "long_green": lambda tick, num_envs: fixed_time_actions(tick, num_envs, green_seconds=6.0),
+    "random": random_actions,
+}
+
+
+def queue_statistics(env, schedule, seconds: float) -> dict:
+    """Runs the VecEnv env under schedule for seconds of simulated time and summarizes
+    its queues, waiting times, collisions and episode returns
+    """
+    env.reset()
+    ticks = round(seconds / TICK_DURATION)
+    observations = np.zeros((ticks, env.num_envs, 6))
+    returns = np.zeros(env.num_envs)
+    episode_returns = []
+    collisions = 0
+    for tick in range(ticks):
+        state, rewards, dones, infos = env.step(schedule(tick, env.num_envs))
+        returns += rewards
+        # Finished episodes are summarized by their last observation, not the reset one
+        for i in np.flatnonzero(dones):
+            state[i] = infos[i]["terminal_observation"]
+            episode_returns.append(returns[i])
+            collisions += infos[i]["reason"] == "collision"
+            returns[i] = 0
+        observations[tick] = state
+    queues = observations[:, :, :4]
+    return {
+        "mean_queue": queues.mean(),
+        "p50_queue": np.percentile(queues, 50),
+        "p90_queue": np.percentile(queues, 90),
+        "p99_queue": np.percentile(queues, 99),
+        "max_queue": queues.max(),
+        "mean_waiting": observations[:, :, 4].mean(),
+        "collisions_per_minute": collisions / (env.num_envs * seconds / 60),
+        "mean_return": np.mean(episode_returns) if episode_returns else np.nan,
+    }
+
+
+def calibrate(num_envs: int = 64, seconds: float = 60.0, seed: int = 0, schedules: dict | None = None, **model_kwargs) -> dict:
+    """Runs TrafficVecEnv, which moves cars exactly like TrafficSim with the array engine,
+    and QueueVecEnv side by side under the same light schedules and arrivals seeded with
+    seed. Returns {schedule: {statistic: (microscopic, queue model)}}.
+    """
+    from vec_env import TrafficVecEnv, QueueVecEnv
+
+    results = {}
+    for name, schedule in (schedules or SCHEDULES).items():
+        micro = queue_statistics(TrafficVecEnv(num_envs, seed=seed), schedule, seconds)
+        meso = queue_statistics(QueueVecEnv(num_envs, seed=seed, **model_kwargs), schedule, seconds)
+        results[name] = {key: (micro[key], meso[key]) for key in micro}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the queue statistics of the queue model with TrafficSim")
+    parser.add_argument("--envs", type=int, default=64, help="intersections simulated side by side")
+    parser.add_argument("--seconds", type=float, default=60.0, help="simulated seconds per schedule")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--headway", type=int, default=SATURATION_HEADWAY, help="queue discharge headway in ticks")
+    args = parser.parse_args()
+
+    results = calibrate(args.envs, args.seconds, args.seed, headway=args.headway)
+    for name, statistics in results.items():
+        print(f"{name}:")
+        print(f"  {'statistic':<24}{'TrafficSim':>12}{'queue model':>12}{'difference':>12}")
+        for key, (micro, meso) in statistics.items():
+            print(f"  {key:<24}{micro:>12.3f}{meso:>12.3f}{meso - micro:>+12.3f}")
+
+
+if __name__ == "__main__":
+    main()
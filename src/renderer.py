@@ -0,0 +1,240 @@
+import threading
+import time
+import numpy as np
+import pygame
+from config import *
+
+RENDER_MODES = ["human", "rgb_array"]
+LIGHT_POSITIONS = {
+    "left": (LIGHT_LEFT_X, LIGHT_LEFT_Y),
+    "right": (LIGHT_RIGHT_X, LIGHT_RIGHT_Y),
+    "top": (LIGHT_TOP_X, LIGHT_TOP_Y),
+    "bottom": (LIGHT_BOTTOM_X, LIGHT_BOTTOM_Y),
+}
+
+
+class Snapshot:
+    """The lights and car positions of a TrafficSim at one tick, shaped like the
+    TrafficSim the Renderer draws, so a frame can be drawn after the simulation moved on
+    """
+    def __init__(self, trafficsim):
+        self.traffic_lights = dict(trafficsim.traffic_lights)
+        self.positions = trafficsim.car_positions()
+
+    def car_positions(self) -> list[tuple[int, int]]:
+        return self.positions
+
+
+class Renderer:
+    """Draws a TrafficSim with pygame.
+
+    "human" opens a window, "rgb_array" draws to an offscreen surface and returns each
+    frame as an array without touching the display.
+
+    The roads are drawn once into a cached scene, which also holds the light boxes and
+    the episode text and is only redrawn where they change. A frame restores the scene
+    under last frame's cars, draws the cars, and updates only those areas of the window.
+
+    By default "human" blocks every frame to hold the simulation at fps, so it plays in
+    real time. With throttle False it never blocks: frames are drawn at most fps times a
+    second of wall time and the others skipped. With threaded, render only snapshots the
+    lights and cars, and only when the last snapshot has been picked up. A background
+    thread draws the latest snapshot at up to fps onto an offscreen canvas, so drawing
+    takes no time from the simulation either. SDL only allows the window to be updated
+    from the thread that handles its events on some platforms, so render copies the
+    areas drawn to the window on the calling thread, as process_events handles events.
+    """
+    def __init__(self, render_mode: str = "human", fps: float = FPS, throttle: bool = True, threaded: bool = False):
+        if render_mode not in RENDER_MODES:
+            raise ValueError(f"Unknown render mode: {render_mode}")
+        if threaded and render_mode != "human":
+            raise ValueError("Only \"human\" rendering can run on a thread")
+        self.render_mode = render_mode
+        self.fps = fps
+        self.throttle = throttle and not threaded
+        if render_mode == "human":
+            pygame.init()
+            self.screen = pygame.display.set_mode((WIDTH, HEIGHT))
+            pygame.display.set_caption("Traffic Simulator")
+        else:
+            pygame.font.init()
+            self.screen = pygame.Surface((WIDTH, HEIGHT))
+        # Frames are drawn here. The render thread draws offscreen, everything else
+        # straight onto the screen.
+        self.canvas = pygame.Surface((WIDTH, HEIGHT)) if threaded else self.screen
+        self.clock = pygame.time.Clock()
+        self.font = pygame.font.Font(None, 36)
+        self.background = pygame.Surface((WIDTH, HEIGHT))
+        self.background.fill(BLACK)
+        self.draw_roads(self.background)
+        self.scene = self.background.copy()
+        self.light_images = {}
+        # What the scene shows, None until first drawn
+        self.scene_lights = dict.fromkeys(LIGHT_POSITIONS)
+        self.scene_episode = None
+        self.text_rect = pygame.Rect(WIDTH - 10, 10, 0, 0)
+        self.car_rects = []
+        self.full_redraw = True
+        self.last_frame_time = None
+
+        self.thread = None
+        if threaded:
+            self.pending = None
+            self.stopping = False
+            # Held while the thread draws onto the canvas, and the areas it drew since
+            # they were last copied to the window
+            self.canvas_lock = threading.Lock()
+            self.drawn = []
+            self.frame_ready = threading.Condition()
+            self.thread = threading.Thread(target=self.render_loop, name="renderer", daemon=True)
+            self.thread.start()
+
+    def process_events(self, trafficsim) -> bool:
+        """Allows user to toggle traffic lights with arrow keys and checks for quit events
+        """
+        if self.render_mode != "human":
+            return True
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                return False
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_UP:
+                    trafficsim.toggle_light("top")
+                elif event.key == pygame.K_DOWN:
+                    trafficsim.toggle_light("bottom")
+                elif event.key == pygame.K_LEFT:
+                    trafficsim.toggle_light("left")
+                elif event.key == pygame.K_RIGHT:
+                    trafficsim.toggle_light("right")
+        return True
+
+    def draw_roads(self, surface: pygame.Surface) -> None:
+        # Vertical road
+        pygame.draw.rect(surface, GRAY, (WIDTH//2 - ROAD_WIDTH//2, 0, ROAD_WIDTH, HEIGHT))
+        # Horizontal road
+        pygame.draw.rect(surface, GRAY, (0, HEIGHT//2 - ROAD_WIDTH//2, WIDTH, ROAD_WIDTH))
+        # Lane dividers
+        pygame.draw.line(surface, WHITE, (WIDTH//2, 0), (WIDTH//2, HEIGHT), 2)
+        pygame.draw.line(surface, WHITE, (0, HEIGHT//2), (WIDTH, HEIGHT//2), 2)
+
+    def light_image(self, color: int) -> pygame.Surface:
+        """A light box showing color, drawn on first use"""
+        if color not in self.light_images:
+            image = pygame.Surface((LIGHT_BOX_WIDTH, LIGHT_BOX_HEIGHT))
+            image.fill(WHITE)
+            colors = [BLACK, BLACK, BLACK]
+            if color == 0:
+                colors[0] = RED
+            if color == 1:
+                colors[1] = GREEN
+
+            # Draw individuals lights inside the box
+            for index, col in enumerate(colors):
+                pygame.draw.circle(image, col, (LIGHT_BOX_WIDTH // 2, LIGHT_SPACING + index * (LIGHT_SIZE + LIGHT_SPACING)
+                                                + LIGHT_SIZE // 2), LIGHT_SIZE // 2)
+            self.light_images[color] = image
+        return self.light_images[color]
+
+    def update_scene(self, traffic_lights: dict, episode_number) -> list[pygame.Rect]:
+        """Redraws the light boxes and episode text that changed into the scene. Returns
+        the areas redrawn.
+        """
+        dirty = []
+        for key, position in LIGHT_POSITIONS.items():
+            if traffic_lights[key] != self.scene_lights[key]:
+                self.scene_lights[key] = traffic_lights[key]
+                dirty.append(self.scene.blit(self.light_image(traffic_lights[key]), position))
+        if episode_number != self.scene_episode:
+            self.scene_episode = episode_number
+            self.scene.blit(self.background, self.text_rect, self.text_rect)
+            text_surface = self.font.render(f"Episode: {episode_number}", True, WHITE)
+            text_rect = text_surface.get_rect(topright=(WIDTH - 10, 10))
+            self.scene.blit(text_surface, text_rect)
+            dirty.append(text_rect.union(self.text_rect))
+            self.text_rect = text_rect
+        return dirty
+
+    def draw(self, trafficsim, episode_number) -> list[pygame.Rect]:
+        """Draws a frame onto the canvas. Returns the areas that changed since the last
+        frame.
+        """
+        dirty = self.update_scene(trafficsim.traffic_lights, episode_number)
+        if self.full_redraw:
+            self.full_redraw = False
+            self.canvas.blit(self.scene, (0, 0))
+            dirty = [self.canvas.get_rect()]
+        else:
+            for rect in dirty + self.car_rects:
+                self.canvas.blit(self.scene, rect, rect)
+        car_rects = []
+        for x, y in trafficsim.car_positions():
+            car_rects.append(pygame.draw.circle(self.canvas, RED, (x, y), CAR_RADIUS))
+        dirty += self.car_rects + car_rects
+        self.car_rects = car_rects
+        return dirty
+
+    def render(self, trafficsim, episode_number) -> np.ndarray | None:
+        if self.thread is not None:
+            self.show_drawn()
+            # A snapshot costs a pass over the cars, so none is taken while the last one
+            # still waits to be drawn. The thread only ever clears pending.
+            if self.pending is None:
+                snapshot = Snapshot(trafficsim)
+                with self.frame_ready:
+                    self.pending = (snapshot, episode_number)
+                    self.frame_ready.notify()
+            return None
+        if self.render_mode == "human" and not self.throttle:
+            now = time.perf_counter()
+            if self.last_frame_time is not None and now - self.last_frame_time < 1 / self.fps:
+                return None
+            self.last_frame_time = now
+
+        dirty = self.draw(trafficsim, episode_number)
+        if self.render_mode == "rgb_array":
+            return np.transpose(pygame.surfarray.array3d(self.screen), (1, 0, 2))
+        pygame.display.update(dirty)
+        if self.throttle:
+            self.clock.tick(self.fps)
+        return None
+
+    def render_loop(self) -> None:
+        """Draws the latest snapshot passed to render, at up to fps frames a second, until
+        close
+        """
+        while True:
+            with self.frame_ready:
+                while self.pending is None and not self.stopping:
+                    self.frame_ready.wait()
+                if self.stopping:
+                    return
+                snapshot, episode_number = self.pending
+                self.pending = None
+            with self.canvas_lock:
+                self.drawn += self.draw(snapshot, episode_number)
+            self.clock.tick(self.fps)
+
+    def show_drawn(self) -> None:
+        """Copies the areas the render thread drew since the last call from the canvas to
+        the window. Skipped while the thread is drawing, so it never blocks.
+        """
+        if not self.drawn or not self.canvas_lock.acquire(blocking=False):
+            return
+        try:
+            drawn, self.drawn = self.drawn, []
+            for rect in drawn:
+                self.screen.blit(self.canvas, rect, rect)
+        finally:
+            self.canvas_lock.release()
+        pygame.display.update(drawn)
+
+    def close(self) -> None:
+        if self.thread is not None:
+            with self.frame_ready:
+                self.stopping = True
+                self.frame_ready.notify()
+            self.thread.join()
+            self.thread = None
+            self.show_drawn()
+        if self.render_mode == "human":
+            pygame.display.quit()
@@ -0,0 +1,74 @@
+"""Replays or summarizes a recording made with TrafficSim.start_recording, without
+re-simulating it.
+
+Run from src/: python replay.py RECORDING [--render] [--episode N] [--speed 4]
+"""
+import argparse
+from trajectory import Trajectory
+
+
+class ReplayFrame:
+    """One recorded tick, shaped like the TrafficSim the Renderer draws"""
+    def __init__(self, trajectory: Trajectory, tick: int):
+        self.traffic_lights = trajectory.lights(tick)
+        cars = trajectory.cars(tick)
+        self.positions = list(zip(cars["x"].tolist(), cars["y"].tolist()))
+
+    def car_positions(self) -> list[tuple[int, int]]:
+        return self.positions
+
+    def toggle_light(self, direction) -> None:
+        # A recording cannot be changed
+        pass
+
+
+def render(trajectory: Trajectory, rows: slice, speed: int = 1, render_mode: str = "human") -> list:
+    """Draws the recorded ticks in rows, every speed-th one, at FPS frames per second.
+    Returns the frames for "rgb_array".
+    """
+    from renderer import Renderer
+
+    renderer = Renderer(render_mode)
+    frames = []
+    try:
+        for tick in range(rows.start, rows.stop, speed):
+            frame = ReplayFrame(trajectory, tick)
+            if not renderer.process_events(frame):
+                break
+            image = renderer.render(frame, int(trajectory["episode"][tick]))
+            if image is not None:
+                frames.append(image)
+    finally:
+        renderer.close()
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay or summarize a recorded trajectory")
+    parser.add_argument("path", help="recording directory")
+    parser.add_argument("--episode", type=int, help="only this episode")
+    parser.add_argument("--render", action="store_true", help="play the recording in a window")
+    parser.add_argument("--speed", type=int, default=1, help="play every n-th tick")
+    args = parser.parse_args()
+
+    trajectory = Trajectory(args.path)
+    summaries = trajectory.summary()
+    episodes = trajectory.episodes()
+    if args.episode is not None:
+        selected = [i for i, summary in enumerate(summaries) if summary["episode"] == args.episode]
+        summaries = [summaries[i] for i in selected]
+        episodes = [episodes[i] for i in selected]
+
+    print(f"{len(trajectory)} ticks, {trajectory.num_cars} car rows")
+    print(f"{'episode':>8} {'ticks':>8} {'seconds':>8} {'reward':>10} {'mean cars':>10} {'max cars':>9} {'queued':>8}")
+    for s in summaries:
+        print(f"{s['episode']:>8} {s['ticks']:>8} {s['seconds']:>8.1f} {s['total_reward']:>10.1f} "
+              f"{s['mean_cars']:>10.1f} {s['max_cars']:>9} {s['mean_queued']:>8.1f}")
+
+    if args.render:
+        for rows in episodes:
+            render(trajectory, rows, args.speed)
+
+
+if __name__ == "__main__":
+    main()
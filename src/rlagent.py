@@ -1,39 +1,77 @@
 import gymnasium as gym
 from gymnasium import spaces
 import numpy as np
+import random
 from stable_baselines3 import PPO
 from stable_baselines3.common.env_checker import check_env
 from stable_baselines3.common.evaluation import evaluate_policy
 from traffic_sim import *
+from profiling import Profiler
 
 class Rlagent(gym.Env):
-    def __init__(self, trafficsim: TrafficSim):
+    metadata = {"render_modes": ["human", "rgb_array"], "render_fps": FPS}
+
+    def __init__(self, trafficsim: TrafficSim, render_mode: str | None = None, decision_interval: int = 1,
+                 render_fps: float | None = None, render_thread: bool = False):
+        """render_mode None runs headless: pygame is never loaded and steps are not
+        throttled. "human" draws every step to a window at FPS, "rgb_array" returns frames
+        from render()
+
+        With render_fps, "human" no longer holds the simulation to real time: the window
+        is redrawn at most render_fps times a second and other steps skip drawing. With
+        render_thread, frames are drawn offscreen on a background thread from snapshots
+        instead, and copied to the window on the calling thread.
+
+        Each step holds the chosen lights for decision_interval ticks and returns the
+        reward accumulated over them
+        """
         super(Rlagent, self).__init__()
+        if render_mode is not None and render_mode not in self.metadata["render_modes"]:
+            raise ValueError(f"Unknown render mode: {render_mode}")
+        self.render_mode = render_mode
         self.trafficsim = trafficsim
+        if render_fps is not None or render_thread:
+            self.trafficsim.render_options = {"fps": render_fps or FPS, "throttle": False, "threaded": render_thread}
+        if decision_interval < 1:
+            raise ValueError("decision_interval must be at least 1")
+        self.decision_interval = decision_interval
         self.action_space = spaces.Discrete(4)
         self.observation_space = spaces.Box(low=0, high=np.inf, shape=(6,), dtype=int)
         self.episode_number = 0
         self.waiting_time_penalty = 50
         self.collision_penalty = 30
+        self.long_queue_threshold = 20
+        # Episode length in simulated seconds
+        self.episode_length = 20
 
+        # Set by enable_profiling
+        self.profiler = None
+
+        # Observation buffer reused by get_state, of the observation space's integer dtype.
+        # The waiting time is truncated to whole seconds, as SB3's vectorized wrappers
+        # always did, and as every other env and the signal service do.
+        self._state = np.zeros(6, dtype=self.observation_space.dtype)
         self.state = self.get_state()
 
     def get_state(self):
-        num_cars_top = len([car for car in self.trafficsim.cars if car.direction in [3] and not car.passed_intersection])
-        num_cars_bottom = len([car for car in self.trafficsim.cars if car.direction in [1] and not car.passed_intersection])
-        num_cars_left = len([car for car in self.trafficsim.cars if car.direction in [0] and not car.passed_intersection])
-        num_cars_right = len([car for car in self.trafficsim.cars if car.direction in [2] and not car.passed_intersection])
-        total_waiting_time = sum(car.waiting_time for car in self.trafficsim.cars)
-        light_states = sum(1 << i for i, light in enumerate(self.trafficsim.traffic_lights.values()) if light == 1)
-        return np.array([num_cars_top, num_cars_bottom, num_cars_left,  num_cars_right, total_waiting_time, light_states])
+        """Observation from the simulator's running counters, written into one reused
+        buffer: the returned array is overwritten by the next call, so copy it to keep it
+        """
+        state = self._state
+        lights = self.trafficsim.traffic_lights
+        state[2], state[1], state[3], state[0] = self.trafficsim.approach_counts()
+        state[4] = self.trafficsim.total_waiting_time()
+        state[5] = (lights["top"] == 1) | (lights["bottom"] == 1) << 1 | (lights["left"] == 1) << 2 | (lights["right"] == 1) << 3
+        return state
 
     
+    def queue_penalty(self, queue_lengths) -> int:
+        return self.waiting_time_penalty * sum(queue_length > self.long_queue_threshold for queue_length in queue_lengths)
+
     def step(self, action: int):
         done = False
         terminated = False
         info = {}
-        current_time = time.time()
-        elapsed_time = current_time - self.start_time
         reward = 0
 
         # Handling actions
@@ -42,27 +80,40 @@ class Rlagent(gym.Env):
         self.trafficsim.traffic_lights["left"] = 1 if action & 2 else 0
         self.trafficsim.traffic_lights["right"] = 1 if action & 2 else 0
 
-        # Run simulation step
-        self.trafficsim.update_simulation()
-        self.trafficsim.render(self.episode_number)
+        if self.trafficsim.recorder is not None:
+            self.trafficsim.recorder.action = action
+
+        # Run the held ticks with advance, so the event engine can jump over quiet ones.
+        # Only the queue counts are needed for their reward, and they stay the same over
+        # a jump. The observation, collision check and rendering wait for the last tick.
+        # The hold ends early on the first tick that starts past the episode length.
+        approach_counts = self.trafficsim.approach_counts
+        held = self.decision_interval - 1
+        within = self.ticks_within_episode() if held else 0
+        timed_out = within < held
+        if held:
+            penalties = []
+            self.trafficsim.advance(within + 1 if timed_out else held,
+                                    lambda ticks: penalties.append(ticks * (self.queue_penalty(approach_counts()) + 1)))
+            reward -= sum(penalties)
+        if not timed_out:
+            timed_out = self.trafficsim.sim_time - self.start_time > self.episode_length
+            self.trafficsim.update_simulation()
+            if self.render_mode == "human":
+                self.trafficsim.render(self.episode_number)
+            reward -= self.queue_penalty(approach_counts()) + 1
         self.state = self.get_state()
 
-        # Check for collision or cars waiting
+        # Check for collision
         collision_occured = self.trafficsim.check_collision()
 
         if collision_occured:
             reward -= self.collision_penalty
 
-        LONG_QUEUE_THRESHOLD = 20
-        queue_lengths = [self.state[i] for i in range(4)]
+        if self.trafficsim.recorder is not None:
+            self.trafficsim.recorder.record_reward(reward)
 
-        for queue_length in queue_lengths:
-            if queue_length > LONG_QUEUE_THRESHOLD:
-                reward -= self.waiting_time_penalty
-        
-        reward -= 1
-
-        if collision_occured or elapsed_time > 20:
+        if collision_occured or timed_out:
             done = True
             terminated = True
             info['reason'] = 'collision'
@@ -71,16 +122,52 @@ class Rlagent(gym.Env):
             done = False
             terminated = False
 
-        return self.state, float(reward), done, terminated, info
+        if self.profiler is not None:
+            self.profiler.gauge("cars", self.trafficsim.car_count)
+            info["profile"] = self.profiler.summary()
+
+        return self.state.copy(), float(reward), done, terminated, info
     
+    def ticks_within_episode(self) -> int:
+        """Number of the next ticks that start within the episode length"""
+        ticks = self.trafficsim.ticks
+        within = max(0, int((self.start_time + self.episode_length) / TICK_DURATION) - ticks - 1)
+        while (ticks + within) * TICK_DURATION - self.start_time <= self.episode_length:
+            within += 1
+        return within
+
     def reset(self, **kwargs):
         seed = kwargs.get('seed', None)
         if seed is not None:
             np.random.seed(seed)
-        self.start_time = time.time()
-        self.trafficsim.reset()
+            random.seed(seed)
+        self.trafficsim.reset(seed=seed)
+        self.start_time = self.trafficsim.sim_time
         self.state = self.get_state()
         self.episode_number += 1
         info = {}
 
-        return self.state, info
\ No newline at end of file
+        return self.state.copy(), info
+
+    def enable_profiling(self, profiler: Profiler | None = None) -> Profiler:
+        """Times the simulation, rendering, collision, observation and step phases of this
+        env and reports them in the info of every step. Without this no time is measured.
+        """
+        self.profiler = profiler if profiler is not None else Profiler()
+        self.profiler.instrument(self.trafficsim, "update_simulation", "simulation")
+        # Held ticks run inside advance, which the event engine can finish without a
+        # single update_simulation
+        self.profiler.instrument(self.trafficsim, "advance", "simulation")
+        self.profiler.instrument(self.trafficsim, "render", "render")
+        self.profiler.instrument(self.trafficsim, "check_collision", "collision")
+        self.profiler.instrument(self, "get_state", "observation")
+        self.profiler.instrument(self, "step", "step")
+        return self.profiler
+
+    def render(self):
+        if self.render_mode is None:
+            return None
+        return self.trafficsim.render(self.episode_number, self.render_mode)
+
+    def close(self):
+        self.trafficsim.close()
@@ -0,0 +1,328 @@
+import numpy as np
+from config import *
+from vehicle_array import SIGN, STOP_P, PASS_P, CONFLICT_START_P, CONFLICT_END_P, blocked_by_leaders, close_pairs
+
+# Progress of the intersection centre for each direction, and the lane lines of config
+# relative to it, so the same geometry can be laid out around every intersection
+CENTER_P = SIGN * np.array([WIDTH // 2, HEIGHT // 2, WIDTH // 2, HEIGHT // 2])
+STOP_OFFSET = STOP_P - CENTER_P
+PASS_OFFSET = PASS_P - CENTER_P
+CONFLICT_START_OFFSET = CONFLICT_START_P - CENTER_P
+CONFLICT_END_OFFSET = CONFLICT_END_P - CENTER_P
+
+
+class RoadNetwork:
+    """Grid of rows x cols signalized intersections joined by two-way roads, with the cars
+    of every intersection stepped at once in a structure-of-arrays store.
+
+    Intersection i sits at row i // cols (top to bottom) and column i % cols (left to
+    right), spacing pixels from its neighbours, and has the lane geometry of the single
+    TrafficSim intersection. Cars drive straight along their row or column: they enter at
+    the edge of the grid, pass each intersection in turn on green and leave at the far
+    edge. Every intersection has its own lights, set from an action with the same bits as
+    Rlagent, and its own slice of the observation.
+
+    A 1 x 1 grid with the default spacing moves cars exactly like a TrafficSim with the
+    array engine.
+
+    The waiting time of an intersection is defined per intersection: it sums the time
+    each car approaching it has waited since passing the intersection before. A car's
+    waiting time is reset as it passes, so it is charged only to the intersection that
+    held it. TrafficSim instead keeps counting a car's waiting time until it leaves the
+    screen, so even a 1 x 1 grid observes a lower waiting time than TrafficSim once held
+    cars have passed.
+    """
+    FIELDS = ["_lane", "_s", "_target", "_speed", "_waiting_time"]
+
+    def __init__(self, rows: int, cols: int, spacing: int = WIDTH // 2, seed: int | None = None, capacity: int = 256):
+        if spacing <= CONFLICT_END_OFFSET.max() - CONFLICT_START_OFFSET.min():
+            raise ValueError("spacing must leave room between the intersection boxes")
+        self.rows = rows
+        self.cols = cols
+        self.spacing = spacing
+        self.num_intersections = rows * cols
+        self.width = spacing * (cols + 1)
+        self.height = spacing * (rows + 1)
+        self.radius = CAR_RADIUS
+        self.np_random = np.random.default_rng(seed)
+        self._build_lanes()
+
+        self.count = 0
+        self._allocate(capacity)
+        # Light state per intersection, in direction order
+        self.traffic_lights = np.ones((self.num_intersections, 4), dtype=np.int64)
+        # Cars per intersection and direction that have not passed it yet
+        self.queue_counts = np.zeros((self.num_intersections, 4), dtype=np.int64)
+        # Summed waiting time of the cars approaching each intersection
+        self.waiting_totals = np.zeros(self.num_intersections, dtype=np.float64)
+        self.ticks = 0
+        self.last_creation_tick = 0
+        self.spawn_interval = round(CAR_SPAWN_RATE / TICK_DURATION)
+        # A single intersection gets one car per interval on a random approach; a grid
+        # gets the same rate per entry lane
+        self.spawns_per_interval = max(1, self.num_lanes // 4)
+
+    def _build_lanes(self) -> None:
+        """Lays out the lanes: one per row for directions 0 and 2 and one per column for
+        directions 1 and 3, numbered by direction. route[lane, k] is the k-th
+        intersection met along a lane, and downstream[i, d] the intersection after i in
+        direction d (-1 at the edge of the grid).
+        """
+        rows, cols = self.rows, self.cols
+        lane_direction = []
+        route = np.full((2 * (rows + cols), max(rows, cols)), -1, dtype=np.int64)
+        origin = []
+        lane = 0
+        for direction in DIRECTIONS:
+            for line in range(rows if direction % 2 == 0 else cols):
+                centre = self.spacing * (line + 1)
+                match direction:
+                    case 0:
+                        route[lane, :cols] = line * cols + np.arange(cols)
+                        origin.append((0, centre + LANE_WIDTH // 2))
+                    case 1:
+                        route[lane, :rows] = np.arange(rows - 1, -1, -1) * cols + line
+                        origin.append((centre + LANE_WIDTH // 2, self.height))
+                    case 2:
+                        route[lane, :cols] = line * cols + np.arange(cols - 1, -1, -1)
+                        origin.append((self.width, centre - LANE_WIDTH // 2))
+                    case 3:
+                        route[lane, :rows] = np.arange(rows) * cols + line
+                        origin.append((centre - LANE_WIDTH // 2, 0))
+                lane_direction.append(direction)
+                lane += 1
+        self.num_lanes = lane
+        self.lane_direction = np.array(lane_direction)
+        self.lane_length = np.where(self.lane_direction % 2 == 0, cols, rows)
+        self.lane_origin = np.array(origin)
+        self.lane_step = np.array(DIRECTION_STEP)[self.lane_direction]
+        self.route = route
+
+        self.downstream = np.full((self.num_intersections, 4), -1, dtype=np.int64)
+        for lane in range(self.num_lanes):
+            stops = route[lane, :self.lane_length[lane]]
+            self.downstream[stops[:-1], self.lane_direction[lane]] = stops[1:]
+
+    def _allocate(self, capacity: int) -> None:
+        n = self.count
+        old = {name: getattr(self, name, None) for name in self.FIELDS}
+        self.capacity = capacity
+        self._lane = np.zeros(capacity, dtype=np.int64)
+        # Progress along the lane from its entry at the edge of the grid
+        self._s = np.zeros(capacity, dtype=np.int64)
+        # Index along the lane of the next intersection to pass, the lane length once
+        # every intersection is passed
+        self._target = np.zeros(capacity, dtype=np.int64)
+        self._speed = np.zeros(capacity, dtype=np.int64)
+        self._waiting_time = np.zeros(capacity, dtype=np.float64)
+        for name, values in old.items():
+            if values is not None:
+                getattr(self, name)[:n] = values[:n]
+
+    def __len__(self) -> int:
+        return self.count
+
+    # Views over the live cars only
+    @property
+    def lane(self) -> np.ndarray:
+        return self._lane[:self.count]
+
+    @property
+    def s(self) -> np.ndarray:
+        return self._s[:self.count]
+
+    @property
+    def target(self) -> np.ndarray:
+        return self._target[:self.count]
+
+    @property
+    def speed(self) -> np.ndarray:
+        return self._speed[:self.count]
+
+    @property
+    def waiting_time(self) -> np.ndarray:
+        return self._waiting_time[:self.count]
+
+    @property
+    def direction(self) -> np.ndarray:
+        return self.lane_direction[self.lane]
+
+    def positions(self) -> np.ndarray:
+        """Screen coordinates of every car, of shape (count, 2)"""
+        return self.lane_origin[self.lane] + self.s[:, None] * self.lane_step[self.lane]
+
+    def car_positions(self) -> list[tuple[int, int]]:
+        return [tuple(pos) for pos in self.positions().tolist()]
+
+    def _approach(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """For every car: whether it still has an intersection ahead, that intersection
+        (-1 if none) and the car's progress relative to its centre
+        """
+        target = self.target
+        ahead = target < self.lane_length[self.lane]
+        intersection = np.where(ahead, self.route[self.lane, np.minimum(target, self.route.shape[1] - 1)], -1)
+        local = self.s - (target + 1) * self.spacing
+        return ahead, intersection, local
+
+    def spawn(self, lanes: np.ndarray, distance: int = 0) -> None:
+        """Appends one car per lane given, distance pixels past its entry, in the order
+        given
+        """
+        lanes = np.asarray(lanes, dtype=np.int64)
+        k = len(lanes)
+        while self.count + k > self.capacity:
+            self._allocate(2 * self.capacity)
+        new = slice(self.count, self.count + k)
+        self._lane[new] = lanes
+        self._s[new] = distance
+        self._speed[new] = CAR_SPEED
+        self._waiting_time[new] = 0
+        # Cars placed beyond an intersection's pass line have already passed it
+        passed = (distance - (np.arange(self.route.shape[1]) + 1) * self.spacing)[None, :] >= PASS_OFFSET[self.lane_direction[lanes]][:, None]
+        self._target[new] = np.minimum(passed.sum(axis=1), self.lane_length[lanes])
+        self.count += k
+        ahead, intersection, _ = self._approach()
+        np.add.at(self.queue_counts, (intersection[new][ahead[new]], self.lane_direction[lanes][ahead[new]]), 1)
+
+    def remove(self, mask: np.ndarray) -> None:
+        """Drops the cars selected by mask, compacting the rest in place while preserving
+        spawn order
+        """
+        keep = ~mask
+        n = int(keep.sum())
+        if n == self.count:
+            return
+        ahead, intersection, _ = self._approach()
+        queued = mask & ahead
+        np.subtract.at(self.queue_counts, (intersection[queued], self.direction[queued]), 1)
+        np.subtract.at(self.waiting_totals, intersection[queued], self.waiting_time[queued])
+        for name in self.FIELDS:
+            values = getattr(self, name)
+            values[:n] = values[:self.count][keep]
+        self.count = n
+
+    def reset(self) -> None:
+        """Removes every car and restarts the clock and lights"""
+        self.count = 0
+        self.queue_counts[:] = 0
+        self.waiting_totals[:] = 0
+        self.traffic_lights[:] = 1
+        self.ticks = 0
+        self.last_creation_tick = 0
+
+    def set_actions(self, actions: np.ndarray) -> None:
+        """Sets every intersection's lights from its action: bit 0 turns top/bottom green,
+        bit 1 left/right, as in Rlagent.step
+        """
+        actions = np.asarray(actions).reshape(self.num_intersections)
+        vertical = (actions & 1) > 0
+        horizontal = (actions & 2) > 0
+        self.traffic_lights[:] = np.stack([horizontal, vertical, horizontal, vertical], axis=1)
+
+    def _red_stops(self) -> np.ndarray:
+        """Cars held by a red light: beyond the stop line of the intersection ahead"""
+        ahead, intersection, local = self._approach()
+        d = self.direction
+        red = self.traffic_lights[intersection, d] == 0
+        return ahead & red & (local > STOP_OFFSET[d])
+
+    def check_traffic(self) -> None:
+        """Stops cars at red lights and moves on the cars that passed an intersection"""
+        stopped = self._red_stops()
+        self.speed[:] = np.where(stopped, 0, CAR_SPEED)
+        self.update_passed(stopped)
+
+    def update_passed(self, stopped=None) -> None:
+        """Cars that are free to move and have reached the far side of the intersection
+        ahead leave its queue and now approach the next one
+        """
+        if stopped is None:
+            stopped = self._red_stops()
+        ahead, intersection, local = self._approach()
+        d = self.direction
+        passing = ahead & ~stopped & (local >= PASS_OFFSET[d])
+        if not passing.any():
+            return
+        np.subtract.at(self.queue_counts, (intersection[passing], d[passing]), 1)
+        np.subtract.at(self.waiting_totals, intersection[passing], self.waiting_time[passing])
+        self.waiting_time[passing] = 0
+        self.target[passing] += 1
+        ahead, intersection, _ = self._approach()
+        entering = passing & ahead
+        np.add.at(self.queue_counts, (intersection[entering], d[entering]), 1)
+
+    def move(self) -> None:
+        """Moves every car, following the car in front along its lane across intersections"""
+        if self.count == 0:
+            return
+        speed = self.speed
+        stopped = blocked_by_leaders(self.lane, self.s, speed)
+        speed[stopped] = 0
+        moving = ~stopped
+        self.s[moving] += speed[moving]
+        waiting = moving & (speed == 0)
+        self.waiting_time[waiting] += TICK_DURATION
+        _, intersection, _ = self._approach()
+        self.waiting_totals += TICK_DURATION * np.bincount(intersection[waiting], minlength=self.num_intersections)
+
+    def out_of_bounds(self) -> np.ndarray:
+        return self.s > (self.lane_length[self.lane] + 1) * self.spacing
+
+    def spawn_due(self) -> None:
+        """Spawns the cars due this tick, each at the entry of a random lane"""
+        if self.ticks - self.last_creation_tick >= self.spawn_interval:
+            self.spawn(self.np_random.integers(0, self.num_lanes, size=self.spawns_per_interval))
+            self.last_creation_tick = self.ticks
+
+    def update_simulation(self) -> None:
+        """Advances every intersection by one tick, in the order of
+        TrafficSim.update_simulation_array
+        """
+        self.check_traffic()
+        self.move()
+        self.update_passed()
+        self.ticks += 1
+        self.spawn_due()
+        self.remove(self.out_of_bounds())
+
+    def _collision_pairs(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Indices of the horizontal and vertical car of every colliding pair and the
+        intersection it happened in, looking only at cars inside an intersection's box
+        """
+        d = self.direction
+        # The only intersection whose box the car can be in
+        k = (self.s - CONFLICT_START_OFFSET[d]) // self.spacing - 1
+        local = self.s - (k + 1) * self.spacing
+        in_zone = (k >= 0) & (k < self.lane_length[self.lane]) & (local <= CONFLICT_END_OFFSET[d])
+        intersection = np.where(in_zone, self.route[self.lane, np.clip(k, 0, self.route.shape[1] - 1)], -1)
+        horizontal = np.flatnonzero(in_zone & (d % 2 == 0))
+        vertical = np.flatnonzero(in_zone & (d % 2 == 1))
+        pos = self.positions()
+        h, v = close_pairs(horizontal, vertical, intersection, pos[:, 0], pos[:, 1], 2 * self.radius)
+        return h, v, intersection[h]
+
+    def collided_intersections(self) -> np.ndarray:
+        """Boolean mask of the intersections with at least one collision"""
+        collided = np.zeros(self.num_intersections, dtype=bool)
+        collided[self._collision_pairs()[2]] = True
+        return collided
+
+    def check_collision(self) -> bool:
+        return len(self._collision_pairs()[0]) > 0
+
+    def approach_counts(self) -> np.ndarray:
+        """Cars per intersection and direction that have not passed it, of shape
+        (num_intersections, 4). This is the live counter, not a copy.
+        """
+        return self.queue_counts
+
+    def total_waiting_time(self) -> np.ndarray:
+        """Summed waiting time of the cars approaching each intersection, counted since they
+        passed the previous one, see RoadNetwork. This is the live counter, not a copy.
+        """
+        return self.waiting_totals
+
+    @property
+    def sim_time(self) -> float:
+        """Simulated seconds since the last reset"""
+        return self.ticks * TICK_DURATION
@@ -0,0 +1,420 @@
+"""Real-time signal control service.
+
+Detector updates arrive as newline-delimited JSON, over a local TCP socket or on stdin,
+one object per line:
+
+    {"id": 7, "intersection": "5th-main", "counts": {"top": 3, "bottom": 0, "left": 5, "right": 1},
+     "waiting_time": 2.4, "lights": {"top": 1, "bottom": 1, "left": 0, "right": 0}}
+
+counts are the cars approaching each stop line that have not passed it, waiting_time the
+summed waiting time of those cars and lights the current light states, as in
+Rlagent.get_state. Each update is answered on the same stream, in order of completion,
+with the phase to show:
+
+    {"id": 7, "intersection": "5th-main", "action": 2, "lights": {...}, "source": "policy", "latency_ms": 1.3}
+
+Updates that arrive together are micro-batched into one forward pass of the policy. An
+update the policy has not answered within the deadline gets the phase of a fixed-time
+plan instead, with source "fallback". A line {"type": "metrics"} is answered with the
+request counters and latency histograms.
+
+A simulated detector feed of headless TrafficSims stands in for hardware.
+
+Run from src/: python signal_service.py [--port 8765 | --stdio] [--simulate 8 --seconds 30]
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from config import *
+
+# Actions, as in Rlagent.step
+ALL_RED = 0
+VERTICAL_GREEN = 1
+HORIZONTAL_GREEN = 2
+# Approaches in observation order, and their light bit in the observation
+APPROACHES = ["top", "bottom", "left", "right"]
+LIGHT_BITS = {"top": 1, "bottom": 2, "left": 4, "right": 8}
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models", "traffic_agent.zip")
+
+
+def observation(update: dict) -> np.ndarray:
+    """The Rlagent.get_state observation of a detector update"""
+    counts = update["counts"]
+    lights = update.get("lights", {})
+    light_bits = sum(bit for key, bit in LIGHT_BITS.items() if lights.get(key) == 1)
+    # The policy was trained on the waiting time in whole seconds
+    waiting_time = int(update.get("waiting_time", 0))
+    return np.array([counts[key] for key in APPROACHES] + [waiting_time, light_bits], dtype=np.float32)
+
+
+def action_lights(action: int) -> dict:
+    """Light states set by action, as in Rlagent.step"""
+    vertical = 1 if action & 1 else 0
+    horizontal = 1 if action & 2 else 0
+    return {"top": vertical, "bottom": vertical, "left": horizontal, "right": horizontal}
+
+
+class FixedTimePlan:
+    """The cycle of pretrain.FixedTimeController on the wall clock: each road green for
+    green_seconds in turn, with all red for clearance_seconds after each phase
+    """
+    def __init__(self, green_seconds: float = 2.0, clearance_seconds: float = 0.5):
+        self.green_seconds = green_seconds
+        self.clearance_seconds = clearance_seconds
+
+    def action(self, seconds: float) -> int:
+        phase_seconds = self.green_seconds + self.clearance_seconds
+        position = seconds % (2 * phase_seconds)
+        if position % phase_seconds >= self.green_seconds:
+            return ALL_RED
+        return VERTICAL_GREEN if position < phase_seconds else HORIZONTAL_GREEN
+
+
+class LatencyHistogram:
+    """Counts of latencies in fixed buckets growing by sqrt(2) from 10 us to about 10 s,
+    so memory stays constant however long the service runs. Exported cumulatively, in the
+    layout of a Prometheus histogram.
+    """
+    BOUNDS = 1e-5 * np.sqrt(2.0) ** np.arange(41)
+
+    def __init__(self):
+        self.counts = np.zeros(len(self.BOUNDS) + 1, dtype=np.int64)
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.counts[np.searchsorted(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile, in seconds"""
+        if self.count == 0:
+            return math.nan
+        bucket = int(np.searchsorted(np.cumsum(self.counts), q * self.count))
+        return float(self.BOUNDS[bucket]) if bucket < len(self.BOUNDS) else math.inf
+
+    def to_dict(self) -> dict:
+        """The histogram as JSON-serializable values. Quantiles are None when there are no
+        samples or they lie beyond the last bucket, as JSON has no NaN or infinity.
+        """
+        cumulative = np.cumsum(self.counts)
+        quantiles = {name: self.quantile(q) for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))}
+        return {"count": self.count, "sum": self.sum,
+                **{name: value if math.isfinite(value) else None for name, value in quantiles.items()},
+                "buckets": {f"{bound:.6g}": int(n) for bound, n in zip(self.BOUNDS, cumulative)}}
+
+    def prometheus(self, name: str) -> list[str]:
+        """Lines of the Prometheus text format for this histogram"""
+        lines = [f"# TYPE {name} histogram"]
+        for bound, n in zip(self.BOUNDS, np.cumsum(self.counts)):
+            lines.append(f'{name}_bucket{{le="{bound:.6g}"}} {n}')
+        lines += [f'{name}_bucket{{le="+Inf"}} {self.count}', f"{name}_sum {self.sum}", f"{name}_count {self.count}"]
+        return lines
+
+
+class MicroBatcher:
+    """Runs the observations submitted while the policy is busy, up to max_batch of them,
+    as one predict call, on a worker thread so the event loop keeps accepting updates.
+    After the first observation of a batch, waits up to max_wait seconds for more.
+    """
+    def __init__(self, predict, max_batch: int = 256, max_wait: float = 0.0005):
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        # One worker, so forward passes never compete for the same cores
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="policy")
+        self.batch_latency = LatencyHistogram()
+        self.batches = 0
+        self.batched = 0
+        self.task = None
+
+    def submit(self, observation: np.ndarray) -> asyncio.Future:
+        """Future of the action for observation"""
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((observation, future))
+        return future
+
+    async def next_batch(self) -> list[tuple[np.ndarray, asyncio.Future]]:
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        end = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            if self.queue.empty():
+                remaining = end - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batch.append(self.queue.get_nowait())
+        return batch
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            observations = np.stack([observation for observation, _ in batch])
+            start = time.perf_counter()
+            try:
+                actions = await loop.run_in_executor(self.executor, self.predict, observations)
+            except Exception as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            self.batch_latency.record(time.perf_counter() - start)
+            self.batches += 1
+            self.batched += len(batch)
+            for (_, future), action in zip(batch, actions):
+                if not future.done():
+                    future.set_result(int(action))
+
+    def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+        self.executor.shutdown(wait=False)
+
+
+class SignalService:
+    """Answers detector updates with phases from predict, a function from observations
+    of shape (N, 6) to N actions such as InferenceEngine.predict, or from fallback when
+    it misses deadline seconds
+    """
+    def __init__(self, predict, deadline: float = 0.02, max_batch: int = 256, max_wait: float = 0.0005,
+                 fallback: FixedTimePlan | None = None):
+        self.batcher = MicroBatcher(predict, max_batch, max_wait)
+        self.deadline = deadline
+        self.fallback = fallback or FixedTimePlan()
+        self.latency = LatencyHistogram()
+        self.counters = {"requests": 0, "policy": 0, "fallback": 0, "deadline_missed": 0, "policy_errors": 0, "bad_requests": 0}
+
+    async def decide(self, update: dict) -> dict:
+        """The response to one detector update"""
+        start = time.perf_counter()
+        future = self.batcher.submit(observation(update))
+        self.counters["requests"] += 1
+        try:
+            # Shielded, so a late answer still completes its batch instead of failing it
+            action = await asyncio.wait_for(asyncio.shield(future), self.deadline)
+            source = "policy"
+        except asyncio.TimeoutError:
+            self.counters["deadline_missed"] += 1
+            # Nobody waits for the late answer any more, or for its error
+            future.add_done_callback(lambda late: late.cancelled() or late.exception())
+            action, source = self.fallback.action(time.time()), "fallback"
+        except Exception:
+            self.counters["policy_errors"] += 1
+            action, source = self.fallback.action(time.time()), "fallback"
+        self.counters[source] += 1
+        latency = time.perf_counter() - start
+        self.latency.record(latency)
+        return {"id": update.get("id"), "intersection": update.get("intersection"), "action": action,
+                "lights": action_lights(action), "source": source, "latency_ms": 1000 * latency}
+
+    async def respond(self, line: bytes) -> dict:
+        try:
+            message = json.loads(line)
+            if message.get("type") == "metrics":
+                return self.metrics()
+            return await self.decide(message)
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            self.counters["bad_requests"] += 1
+            return {"error": f"{type(error).__name__}: {error}"}
+
+    async def handle(self, reader: asyncio.StreamReader, write) -> None:
+        """Answers every line read from reader, concurrently, passing each response line
+        to write as it completes
+        """
+        async def answer(line: bytes) -> None:
+            write(json.dumps(await self.respond(line)).encode() + b"\n")
+
+        pending = set()
+        while line := await reader.readline():
+            if line.strip():
+                task = asyncio.create_task(answer(line))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.wait(pending)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await self.handle(reader, writer.write)
+        finally:
+            writer.close()
+
+    async def serve_tcp(self, host: str = "127.0.0.1", port: int = 8765) -> asyncio.Server:
+        """Starts listening on host:port. Port 0 picks a free port."""
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def serve_stdio(self) -> None:
+        """Answers updates read from stdin on stdout until stdin closes"""
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+        def write(data: bytes) -> None:
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+        await self.handle(reader, write)
+
+    def metrics(self) -> dict:
+        batcher = self.batcher
+        return {"counters": dict(self.counters), "latency_s": self.latency.to_dict(),
+                "batch_latency_s": batcher.batch_latency.to_dict(),
+                "batches": batcher.batches, "mean_batch_size": batcher.batched / max(1, batcher.batches)}
+
+    def prometheus(self) -> str:
+        lines = []
+        for name, value in self.counters.items():
+            lines += [f"# TYPE signal_service_{name}_total counter", f"signal_service_{name}_total {value}"]
+        lines += ["# TYPE signal_service_batches_total counter", f"signal_service_batches_total {self.batcher.batches}"]
+        lines += self.latency.prometheus("signal_service_latency_seconds")
+        lines += self.batcher.batch_latency.prometheus("signal_service_batch_latency_seconds")
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self, path: str) -> None:
+        """Writes the metrics to path, in the Prometheus text format if it ends in .prom
+        and as JSON otherwise
+        """
+        with open(path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.metrics(), f, indent=2)
+
+    def close(self) -> None:
+        self.batcher.close()
+
+
+class SimulatedFeed:
+    """Detector hardware stand-in: num_intersections headless TrafficSims, each on its own
+    connection, sending its detector update every decision_interval ticks and showing the
+    phase it gets back. With realtime, each runs no faster than the wall clock.
+    """
+    def __init__(self, num_intersections: int = 8, decision_interval: int = 12, seed: int = 0, realtime: bool = True):
+        from traffic_sim import TrafficSim
+
+        self.sims = []
+        for i in range(num_intersections):
+            sim = TrafficSim(engine="array")
+            sim.reset(seed=seed + i)
+            self.sims.append(sim)
+        self.decision_interval = decision_interval
+        self.realtime = realtime
+        self.updates = 0
+        self.collisions = 0
+
+    def update(self, i: int, step: int) -> dict:
+        sim = self.sims[i]
+        return {"id": step, "intersection": i, "counts": dict(zip(LIGHT_KEYS, sim.approach_counts())),
+                "waiting_time": sim.total_waiting_time(), "lights": dict(sim.traffic_lights)}
+
+    async def drive(self, i: int, host: str, port: int, seconds: float) -> None:
+        sim = self.sims[i]
+        reader, writer = await asyncio.open_connection(host, port)
+        period = self.decision_interval * TICK_DURATION
+        start = time.perf_counter()
+        try:
+            for step in range(round(seconds / period)):
+                writer.write(json.dumps(self.update(i, step)).encode() + b"\n")
+                self.updates += 1
+                response = json.loads(await reader.readline())
+                sim.traffic_lights.update(response["lights"])
+                sim.advance(self.decision_interval)
+                # As in Rlagent, a collision ends the episode
+                if sim.check_collision():
+                    self.collisions += 1
+                    sim.reset()
+                if self.realtime:
+                    await asyncio.sleep(max(0.0, start + (step + 1) * period - time.perf_counter()))
+        finally:
+            writer.close()
+
+    async def run(self, host: str, port: int, seconds: float) -> None:
+        """Drives every intersection for seconds of simulated time"""
+        await asyncio.gather(*(self.drive(i, host, port, seconds) for i in range(len(self.sims))))
+
+
+async def simulate(service: SignalService, num_intersections: int, seconds: float, realtime: bool, seed: int) -> SimulatedFeed:
+    server = await service.serve_tcp("127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    feed = SimulatedFeed(num_intersections, seed=seed, realtime=realtime)
+    async with server:
+        await feed.run("127.0.0.1", port, seconds)
+    return feed
+
+
+async def serve(service: SignalService, args) -> None:
+    async def export_metrics() -> None:
+        while True:
+            await asyncio.sleep(args.metrics_interval)
+            service.write_metrics(args.metrics_output)
+
+    exporter = asyncio.create_task(export_metrics()) if args.metrics_output else None
+    try:
+        if args.stdio:
+            await service.serve_stdio()
+        else:
+            server = await service.serve_tcp(args.host, args.port)
+            print(f"Listening on {args.host}:{server.sockets[0].getsockname()[1]}", file=sys.stderr)
+            async with server:
+                await server.serve_forever()
+    finally:
+        if exporter is not None:
+            exporter.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve signal phases from a trained policy")
+    parser.add_argument("--model", default=MODEL_PATH, help="saved PPO model to serve")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--stdio", action="store_true", help="read updates from stdin and answer on stdout")
+    parser.add_argument("--deadline-ms", type=float, default=20.0, help="answer from the fixed-time plan after this")
+    parser.add_argument("--max-batch", type=int, default=256)
+    parser.add_argument("--max-wait-ms", type=float, default=0.5, help="time to wait for a batch to fill")
+    parser.add_argument("--threads", type=int, default=1, help="torch threads for the policy")
+    parser.add_argument("--metrics-output", help="write the metrics here, as Prometheus text if it ends in .prom")
+    parser.add_argument("--metrics-interval", type=float, default=10.0, help="seconds between metrics writes")
+    parser.add_argument("--simulate", type=int, metavar="N", help="serve N simulated intersections and exit")
+    parser.add_argument("--seconds", type=float, default=30.0, help="simulated seconds per intersection")
+    parser.add_argument("--fast", action="store_true", help="run the simulated feed faster than real time")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from inference import InferenceEngine
+
+    engine = InferenceEngine.load(args.model, num_threads=args.threads)
+    service = SignalService(engine.predict, args.deadline_ms / 1000, args.max_batch, args.max_wait_ms / 1000)
+    try:
+        if args.simulate:
+            feed = asyncio.run(simulate(service, args.simulate, args.seconds, not args.fast, args.seed))
+            print(json.dumps({"updates": feed.updates, "collisions": feed.collisions, **service.metrics()["counters"]}))
+            latency = service.latency
+            print(f"Latency p50 {1000 * latency.quantile(0.5):.2f} ms, p90 {1000 * latency.quantile(0.9):.2f} ms, "
+                  f"p99 {1000 * latency.quantile(0.99):.2f} ms, mean batch {service.metrics()['mean_batch_size']:.1f}")
+        else:
+            asyncio.run(serve(service, args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.metrics_output:
+            service.write_metrics(args.metrics_output)
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
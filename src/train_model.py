@@ -1,32 +1,144 @@
 import os
+import time
 from rlagent import *
 from traffic_sim import TrafficSim
-from stable_baselines3.common.callbacks import CheckpointCallback
-from stable_baselines3.common.callbacks import BaseCallback
+from stable_baselines3.common.vec_env import SubprocVecEnv
+from profiling import Profiler, ProfilerCallback
+from checkpoint import CheckpointManager
+from evaluation import AsyncEvaluator
+
+
+def make_worker_env(seed: int, decision_interval: int = 1, profile: bool = False):
+    """Builds a headless Rlagent seeded with seed, for use in a rollout worker process"""
+    def init():
+        env = Rlagent(TrafficSim(), decision_interval=decision_interval)
+        if profile:
+            env.enable_profiling()
+        env.reset(seed=seed)
+        return env
+    return init
+
     
 class TrainModel:
-    def __init__(self):
-        self.env = Rlagent(TrafficSim())
-        self.model = PPO("MlpPolicy", self.env, verbose=1)
+    def __init__(self, render_mode: str | None = "human", num_workers: int = 1, seed: int = 0,
+                 decision_interval: int = 1, profile: bool = False, checkpoint_dir: str = "./models/checkpoints",
+                 checkpoint_interval: int = 10, keep_checkpoints: int = 5, resume: bool = False,
+                 eval_interval: int = 10, eval_episodes: int = 10, max_timesteps: int | None = None):
+        """Trains until the simulator window is closed, max_timesteps timesteps have been
+        trained in total, counting those before a resume, or training is interrupted with
+        Ctrl+C. The model is saved in every case. With render_mode None training runs
+        headless and as fast as the simulator allows, so there is no window to close.
+
+        With num_workers > 1, rollouts are collected by that many headless Rlagent
+        instances in separate processes, seeded seed, seed + 1, ..., feeding one PPO learner.
+
+        decision_interval is the number of simulator ticks each chosen action is held for.
+
+        With profile, the time spent per phase (simulation, rendering, collision checks,
+        observations, env steps, rollouts and PPO updates) during each iteration is
+        printed after it and recorded to the SB3 logger under profile/.
+
+        Every checkpoint_interval iterations the model, with its optimizer state, the
+        counters and the RNG states, is checkpointed to checkpoint_dir in the background,
+        keeping the newest keep_checkpoints, and exported to models/traffic_agent.zip. With
+        resume, training continues from the latest checkpoint if there is one, with the
+        traffic continuing from the checkpointed state of the demand's Generator. Rollout
+        workers are reseeded from seed, as their RNGs live in other processes.
+
+        Every eval_interval iterations a snapshot of the policy is evaluated over
+        eval_episodes episodes in a separate process, while training carries on. Results
+        are printed, and recorded to the SB3 logger under eval/, as they arrive.
+        """
+        self.num_workers = num_workers
+        if num_workers > 1:
+            self.env = SubprocVecEnv([make_worker_env(seed + rank, decision_interval, profile) for rank in range(num_workers)])
+        else:
+            self.env = Rlagent(TrafficSim(), render_mode=render_mode, decision_interval=decision_interval)
+        self.checkpoints = CheckpointManager(checkpoint_dir, keep_checkpoints)
+        self.checkpoint_interval = checkpoint_interval
         self.iteration = 0
+        self.total_timesteps = 0
+        latest = self.checkpoints.latest() if resume else None
+        if latest is not None:
+            self.model, counters = self.checkpoints.load(latest, env=self.env, demand=self.demand())
+            self.iteration = counters["iteration"] + 1
+            self.total_timesteps = counters["total_timesteps"]
+            print(f'Resumed from {latest} at iteration {self.iteration}')
+        else:
+            self.model = PPO("MlpPolicy", self.env, verbose=1, seed=seed)
+        self.profiler = None
+        self.callback = None
+        if profile:
+            self.profiler = Profiler()
+            if num_workers == 1:
+                self.env.enable_profiling(self.profiler)
+            self.profiler.instrument(self.model, "collect_rollouts", "rollout")
+            self.profiler.instrument(self.model, "train", "ppo_update")
+            self.callback = ProfilerCallback(self.profiler)
+        self.evaluator = AsyncEvaluator(eval_episodes, seed, decision_interval, self.model.policy_kwargs)
+        self.eval_interval = eval_interval
+        self.max_timesteps = max_timesteps
+        self.steps_per_second = 0.0
         self.check_done = False
-        while not self.check_done:
-            print(f'Starting training iteration: {self.iteration}')
-            self.model.learn(total_timesteps=1000)
+        interrupted = False
+        try:
+            while not self.check_done:
+                print(f'Starting training iteration: {self.iteration}')
+                start = time.perf_counter()
+                self.model.learn(total_timesteps=1000, callback=self.callback)
+                self.steps_per_second = self.model.num_timesteps / (time.perf_counter() - start)
+                self.total_timesteps += self.model.num_timesteps
+                print(f'Iteration: {self.iteration}, {self.num_workers} worker(s), {self.steps_per_second:.0f} steps/s')
+                if self.profiler is not None:
+                    print(self.profiler.report())
+                    self.profiler.reset()
+
+                if self.iteration % self.eval_interval == 0:
+                    self.evaluator.submit(self.iteration, self.model.policy)
+                self.report_evaluations(self.evaluator.poll())
+
+                self.check_done = self.quit_requested() or self.budget_spent()
+                if self.iteration % self.checkpoint_interval == 0 or self.check_done:
+                    self.save_model()
+                self.iteration += 1
+        except KeyboardInterrupt:
+            print(f'Interrupted, saving iteration {self.iteration}')
+            interrupted = True
+            self.save_model()
+        self.checkpoints.close()
+        # After Ctrl+C, stop without waiting for evaluations still running
+        self.report_evaluations(self.evaluator.close(wait=not interrupted))
+
+    def report_evaluations(self, results: list[dict]) -> None:
+        for result in results:
+            print(f'Evaluation of iteration {result["iteration"]}, received at iteration {self.iteration}: '
+                  f'mean reward {result["mean_reward"]} +/- {result["std_reward"]} ({result["seconds"]:.1f}s)')
+            self.model.logger.record("eval/mean_reward", result["mean_reward"])
+            self.model.logger.record("eval/std_reward", result["std_reward"])
+
+    def budget_spent(self) -> bool:
+        return self.max_timesteps is not None and self.total_timesteps >= self.max_timesteps
 
-            if self.iteration % 10 == 0:
-                mean_reward, std_reward = evaluate_policy(self.model.policy, self.model.get_env(), n_eval_episodes=10)
-                print(f'Iteration: {self.iteration}, Mean reward: {mean_reward} +/- {std_reward}')
-            
-            if self.iteration % 50 == 0:
-                self.save_model()
+    def quit_requested(self) -> bool:
+        """Whether the simulator window was closed. Worker processes are headless and
+        never ask to quit, so only a budget or Ctrl+C ends multi-worker training.
+        """
+        if self.num_workers > 1:
+            return False
+        return not self.env.trafficsim.process_events()
 
-            self.check_done = self.env.trafficsim.process_events()
-            self.iteration += 1
+    def demand(self):
+        """The Demand spawning the cars of the training env, None when it lives in worker
+        processes
+        """
+        if self.num_workers > 1:
+            return None
+        return self.env.trafficsim.demand
 
     def save_model(self):
-        model_save_dir = "./models"
-        if not os.path.exists(model_save_dir):
-            os.makedirs(model_save_dir)
-        model_save_path = os.path.join(model_save_dir, "traffic_agent")
-        self.model.save(model_save_path)
+        """Checkpoints the model in the background and exports it to models/traffic_agent.zip"""
+        model_save_path = os.path.join("./models", "traffic_agent.zip")
+        # Profiling wraps these methods on the model, and the wrappers are not worth saving
+        self.checkpoints.save(self.model, self.iteration, {"total_timesteps": self.total_timesteps},
+                              export_path=model_save_path, exclude=["collect_rollouts", "train"],
+                              demand=self.demand())
@@ -0,0 +1,187 @@
+"""Compact columnar recordings of simulated episodes.
+
+A recording is a directory holding one raw little-endian binary file per column and a
+meta.json describing them. Tick columns have one row per simulated tick, car columns one
+row per car per tick, in the order of the ticks. Columns are appended a chunk of ticks at
+a time, so recording uses bounded memory, and read back as memory maps, so long
+recordings can be analysed without loading them.
+"""
+import json
+import os
+import numpy as np
+from config import *
+
+VERSION = 1
+TICK_COLUMNS = {
+    "episode": "<i4",
+    "tick": "<i4",
+    "car_count": "<i4",
+    # Bit d holds the light of direction d
+    "lights": "u1",
+    # Action in force during the tick, -1 when the lights were not set by an agent
+    "action": "i1",
+    # Reward of an agent step, on the last tick of the step
+    "reward": "<f4",
+}
+CAR_COLUMNS = {
+    "x": "<i2",
+    "y": "<i2",
+    "direction": "u1",
+    "speed": "u1",
+    "waiting_time": "<f4",
+    "passed_intersection": "u1",
+}
+
+
+def car_columns(trafficsim) -> dict:
+    """The per-car columns of every car on screen, in lane order for the object engine
+    and spawn order for the array and event engines
+    """
+    if trafficsim.engine != "object":
+        cars = trafficsim.car_array
+        return {name: getattr(cars, name) for name in CAR_COLUMNS}
+    cars = [car for lane in trafficsim.lanes for car in lane]
+    return {name: np.fromiter((getattr(car, name) for car in cars), dtype=dtype, count=len(cars))
+            for name, dtype in CAR_COLUMNS.items()}
+
+
+class TrajectoryRecorder:
+    """Streams the state of a TrafficSim after every tick to a recording at path.
+
+    Ticks are buffered in memory and appended to the column files every chunk_ticks
+    ticks, and meta.json is rewritten on every append, so an interrupted recording stays
+    readable up to its last full chunk.
+    """
+    def __init__(self, path: str, chunk_ticks: int = 1024):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk_ticks = chunk_ticks
+        self.episode = 0
+        # Set by the agent driving the lights
+        self.action = -1
+        self.num_ticks = 0
+        self.num_cars = 0
+        self.files = {name: open(os.path.join(path, f"{name}.bin"), "wb")
+                      for name in list(TICK_COLUMNS) + list(CAR_COLUMNS)}
+        self._ticks = {name: np.zeros(chunk_ticks, dtype=dtype) for name, dtype in TICK_COLUMNS.items()}
+        self._cars = {name: [] for name in CAR_COLUMNS}
+        self._buffered = 0
+
+    def record(self, trafficsim) -> None:
+        """Appends the state of trafficsim after its latest tick"""
+        if self._buffered == self.chunk_ticks:
+            self.flush()
+        cars = car_columns(trafficsim)
+        row = self._buffered
+        self._ticks["episode"][row] = self.episode
+        self._ticks["tick"][row] = trafficsim.ticks
+        self._ticks["car_count"][row] = len(cars["x"])
+        self._ticks["lights"][row] = sum(1 << d for d, key in enumerate(LIGHT_KEYS) if trafficsim.traffic_lights[key])
+        self._ticks["action"][row] = self.action
+        self._ticks["reward"][row] = 0
+        for name, dtype in CAR_COLUMNS.items():
+            self._cars[name].append(np.asarray(cars[name], dtype=dtype))
+        self._buffered += 1
+
+    def record_reward(self, reward: float) -> None:
+        """Sets the reward of the latest tick, which stays buffered until the next record"""
+        self._ticks["reward"][self._buffered - 1] = reward
+
+    def new_episode(self) -> None:
+        self.episode += 1
+
+    def flush(self) -> None:
+        """Appends the buffered ticks to the column files and updates meta.json"""
+        n = self._buffered
+        for name, values in self._ticks.items():
+            self.files[name].write(values[:n].tobytes())
+        for name, chunks in self._cars.items():
+            if chunks:
+                values = np.concatenate(chunks)
+                self.files[name].write(values.tobytes())
+                chunks.clear()
+        for f in self.files.values():
+            f.flush()
+        self.num_ticks += n
+        self.num_cars += int(self._ticks["car_count"][:n].sum())
+        self._buffered = 0
+        self.write_meta()
+
+    def write_meta(self) -> None:
+        meta = {
+            "version": VERSION,
+            "num_ticks": self.num_ticks,
+            "num_cars": self.num_cars,
+            "tick_duration": TICK_DURATION,
+            "tick_columns": TICK_COLUMNS,
+            "car_columns": CAR_COLUMNS,
+        }
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+    def close(self) -> None:
+        self.flush()
+        for f in self.files.values():
+            f.close()
+
+
+class Trajectory:
+    """Read-only view of a recording, with every column memory mapped"""
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != VERSION:
+            raise ValueError(f"Unsupported recording version: {self.meta['version']}")
+        self.path = path
+        self.num_ticks = self.meta["num_ticks"]
+        self.num_cars = self.meta["num_cars"]
+        self.columns = {}
+        for columns, rows in ((self.meta["tick_columns"], self.num_ticks), (self.meta["car_columns"], self.num_cars)):
+            for name, dtype in columns.items():
+                self.columns[name] = np.memmap(os.path.join(path, f"{name}.bin"), dtype=dtype, mode="r", shape=(rows,)) \
+                    if rows else np.zeros(0, dtype=dtype)
+        # Row of each tick's first car in the car columns
+        self.car_offsets = np.zeros(self.num_ticks + 1, dtype=np.int64)
+        np.cumsum(self.columns["car_count"], out=self.car_offsets[1:])
+
+    def __len__(self) -> int:
+        return self.num_ticks
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def cars(self, tick: int) -> dict:
+        """The car columns of the tick at row tick"""
+        rows = slice(self.car_offsets[tick], self.car_offsets[tick + 1])
+        return {name: self.columns[name][rows] for name in self.meta["car_columns"]}
+
+    def lights(self, tick: int) -> dict:
+        """Light states of the tick at row tick, keyed like TrafficSim.traffic_lights"""
+        bits = int(self.columns["lights"][tick])
+        return {key: (bits >> d) & 1 for d, key in enumerate(LIGHT_KEYS)}
+
+    def episodes(self) -> list[slice]:
+        """Rows of each recorded episode"""
+        episode = np.asarray(self.columns["episode"])
+        starts = np.flatnonzero(np.diff(episode, prepend=-1))
+        ends = np.append(starts[1:], self.num_ticks)
+        return [slice(int(start), int(end)) for start, end in zip(starts, ends)]
+
+    def summary(self) -> list[dict]:
+        """Per-episode statistics computed from the columns alone"""
+        summaries = []
+        for rows in self.episodes():
+            car_rows = slice(self.car_offsets[rows.start], self.car_offsets[rows.stop])
+            waiting = (np.asarray(self.columns["passed_intersection"][car_rows]) == 0)
+            car_counts = np.asarray(self.columns["car_count"][rows])
+            summaries.append({
+                "episode": int(self.columns["episode"][rows.start]),
+                "ticks": rows.stop - rows.start,
+                "seconds": (rows.stop - rows.start) * self.meta["tick_duration"],
+                "total_reward": float(np.asarray(self.columns["reward"][rows], dtype=np.float64).sum()),
+                "mean_cars": float(car_counts.mean()),
+                "max_cars": int(car_counts.max()),
+                "mean_queued": float(waiting.sum() / len(car_counts)),
+                "stopped_car_ticks": int((np.asarray(self.columns["speed"][car_rows]) == 0).sum()),
+            })
+        return summaries
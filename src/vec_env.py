@@ -0,0 +1,228 @@
+import numpy as np
+from gymnasium import spaces
+from stable_baselines3.common.vec_env import VecEnv
+from config import *
+from vehicle_array import VehArray
+from road_network import RoadNetwork
+from queue_model import QueueModel
+
+# Light state bit of each direction in the observation, indexed in direction order (left,
+# bottom, right, top). The bits follow the order of TrafficSim.traffic_lights, as in
+# Rlagent.get_state: top is bit 0, bottom bit 1, left bit 2 and right bit 3.
+LIGHT_BITS = np.array([1 << 2, 1 << 1, 1 << 3, 1 << 0])
+# Observation order of the approach queues: top, bottom, left, right
+QUEUE_ORDER = [3, 1, 0, 2]
+
+
+class SharedVecEnv(VecEnv):
+    """Base for VecEnvs whose envs are all simulated by this one object.
+
+    Subclasses set simulator, which provides approach_counts and total_waiting_time per
+    intersection, and traffic_lights, and get Rlagent's observation and reward from them.
+    """
+    def __init__(self, num_envs: int):
+        self.render_mode = None
+        self.waiting_time_penalty = 50
+        self.collision_penalty = 30
+        self.long_queue_threshold = 20
+        # Episode length in simulated seconds
+        self.episode_length = 20
+        self.actions = np.zeros(num_envs, dtype=np.int64)
+        observation_space = spaces.Box(low=0, high=np.inf, shape=(6,), dtype=int)
+        action_space = spaces.Discrete(4)
+        super().__init__(num_envs, observation_space, action_space)
+
+    def get_state(self) -> np.ndarray:
+        """Observations of every intersection, laid out like Rlagent.get_state"""
+        state = np.empty((self.num_envs, 6))
+        state[:, :4] = self.simulator.approach_counts()[:, QUEUE_ORDER]
+        # Whole seconds, as in Rlagent's integer observation
+        state[:, 4] = np.trunc(self.simulator.total_waiting_time())
+        state[:, 5] = (self.traffic_lights == 1) @ LIGHT_BITS
+        return state
+
+    def rewards(self, state: np.ndarray, collided: np.ndarray) -> np.ndarray:
+        """Rlagent's reward of every intersection"""
+        long_queues = (state[:, :4] > self.long_queue_threshold).sum(axis=1)
+        return -1.0 - self.collision_penalty * collided - self.waiting_time_penalty * long_queues
+
+    def step_async(self, actions: np.ndarray) -> None:
+        self.actions = np.asarray(actions).reshape(self.num_envs)
+
+    def close(self) -> None:
+        pass
+
+    def _indices(self, indices) -> list[int]:
+        if indices is None:
+            return list(range(self.num_envs))
+        if isinstance(indices, int):
+            return [indices]
+        return list(indices)
+
+    # The intersections share this object, so attributes and methods are shared too
+    def get_attr(self, attr_name: str, indices=None) -> list:
+        return [getattr(self, attr_name) for _ in self._indices(indices)]
+
+    def set_attr(self, attr_name: str, value, indices=None) -> None:
+        setattr(self, attr_name, value)
+
+    def env_method(self, method_name: str, *method_args, indices=None, **method_kwargs) -> list:
+        method = getattr(self, method_name)
+        return [method(*method_args, **method_kwargs) for _ in self._indices(indices)]
+
+    def env_is_wrapped(self, wrapper_class, indices=None) -> list[bool]:
+        return [False for _ in self._indices(indices)]
+
+
+class LockstepVecEnv(SharedVecEnv):
+    """Base for VecEnvs of independent intersections stepped in lockstep, each with
+    Rlagent's spawning, episode length and auto-reset.
+
+    Subclasses set simulator, which also provides collided_envs and clear, and implement
+    tick, which runs one simulator tick.
+    """
+    def __init__(self, num_envs: int, seed: int | None = None):
+        self.spawn_interval = round(CAR_SPAWN_RATE / TICK_DURATION)
+        self.np_random = np.random.default_rng(seed)
+        # Light state per intersection, in direction order
+        self.traffic_lights = np.ones((num_envs, 4), dtype=np.int64)
+        self.ticks = np.zeros(num_envs, dtype=np.int64)
+        self.last_creation_tick = np.zeros(num_envs, dtype=np.int64)
+        self.episode_number = np.zeros(num_envs, dtype=np.int64)
+        super().__init__(num_envs)
+
+    def tick(self, spawn_envs: np.ndarray, directions: np.ndarray) -> None:
+        """Runs one tick of every intersection under traffic_lights, spawning a car from
+        each of directions at the intersections spawn_envs
+        """
+        raise NotImplementedError
+
+    def reset_envs(self, envs: np.ndarray) -> None:
+        """Restarts the intersections selected by the boolean mask envs"""
+        self.simulator.clear(envs)
+        self.traffic_lights[envs] = 1
+        self.ticks[envs] = 0
+        self.last_creation_tick[envs] = 0
+        self.episode_number[envs] += 1
+
+    def reset(self) -> np.ndarray:
+        if self._seeds[0] is not None:
+            self.np_random = np.random.default_rng(self._seeds[0])
+        self._reset_seeds()
+        self.reset_envs(np.ones(self.num_envs, dtype=bool))
+        return self.get_state()
+
+    def step_wait(self):
+        # Handling actions: bit 0 drives top/bottom, bit 1 left/right
+        vertical = (self.actions & 1) > 0
+        horizontal = (self.actions & 2) > 0
+        self.traffic_lights[:] = np.stack([horizontal, vertical, horizontal, vertical], axis=1)
+
+        self.ticks += 1
+        due = self.ticks - self.last_creation_tick >= self.spawn_interval
+        spawn_envs = np.flatnonzero(due)
+        directions = self.np_random.integers(0, 4, size=len(spawn_envs))
+        self.last_creation_tick[due] = self.ticks[due]
+        self.tick(spawn_envs, directions)
+
+        state = self.get_state()
+        collided = self.simulator.collided_envs()
+        rewards = self.rewards(state, collided)
+        # Rlagent checks the time limit against the clock before the tick it runs
+        timed_out = (self.ticks - 1) * TICK_DURATION > self.episode_length
+        dones = collided | timed_out
+
+        infos = [{} for _ in range(self.num_envs)]
+        if dones.any():
+            for i in np.flatnonzero(dones):
+                infos[i]["terminal_observation"] = state[i].copy()
+                infos[i]["reason"] = "collision" if collided[i] else "time_limit"
+            self.reset_envs(dones)
+            state = self.get_state()
+        return state, rewards.astype(np.float32), dones, infos
+
+
+class TrafficVecEnv(LockstepVecEnv):
+    """num_envs independent intersections simulated in one VehArray and stepped in
+    lockstep, behind Stable-Baselines3's VecEnv interface.
+
+    Each intersection follows the same rules, observation, reward and episode length as
+    Rlagent around a TrafficSim with the array engine. Finished intersections are reset
+    automatically, with their last observation in info["terminal_observation"].
+    """
+    def __init__(self, num_envs: int, seed: int | None = None):
+        self.cars = VehArray(capacity=64 * num_envs, num_envs=num_envs)
+        self.simulator = self.cars
+        super().__init__(num_envs, seed)
+
+    def tick(self, spawn_envs: np.ndarray, directions: np.ndarray) -> None:
+        # As in TrafficSim.update_simulation_array
+        self.cars.check_traffic(self.traffic_lights)
+        self.cars.move()
+        self.cars.update_passed(self.traffic_lights)
+        if len(spawn_envs):
+            self.cars.spawn_many(spawn_envs, directions)
+        self.cars.remove_out_of_bounds()
+
+
+class QueueVecEnv(LockstepVecEnv):
+    """num_envs intersections simulated by the mesoscopic QueueModel instead of moving
+    cars, behind the same interface, observation, actions, reward and episodes as
+    TrafficVecEnv and many times faster, for bulk pretraining and sweeps before
+    fine-tuning on TrafficSim. See queue_model.calibrate for how closely it tracks it.
+    """
+    def __init__(self, num_envs: int, seed: int | None = None, **model_kwargs):
+        self.model = QueueModel(num_envs, **model_kwargs)
+        self.simulator = self.model
+        super().__init__(num_envs, seed)
+
+    def tick(self, spawn_envs: np.ndarray, directions: np.ndarray) -> None:
+        self.model.step(self.traffic_lights)
+        if len(spawn_envs):
+            self.model.spawn(spawn_envs, directions)
+
+
+class GridVecEnv(SharedVecEnv):
+    """The intersections of one RoadNetwork as the envs of a VecEnv, for training a
+    policy shared by every intersection.
+
+    Each intersection gets Rlagent's observation and reward from its own slice of the
+    network, except that its waiting time only counts the cars still approaching it,
+    see RoadNetwork. The network runs one episode for all of them: when any intersection
+    collides or the episode runs out, every intersection is done and the network is
+    reset.
+    """
+    def __init__(self, rows: int, cols: int, seed: int | None = None, **network_kwargs):
+        self.network = RoadNetwork(rows, cols, seed=seed, **network_kwargs)
+        self.simulator = self.network
+        super().__init__(self.network.num_intersections)
+
+    @property
+    def traffic_lights(self) -> np.ndarray:
+        return self.network.traffic_lights
+
+    def reset(self) -> np.ndarray:
+        if self._seeds[0] is not None:
+            self.network.np_random = np.random.default_rng(self._seeds[0])
+        self._reset_seeds()
+        self.network.reset()
+        return self.get_state()
+
+    def step_wait(self):
+        self.network.set_actions(self.actions)
+        self.network.update_simulation()
+
+        state = self.get_state()
+        collided = self.network.collided_intersections()
+        rewards = self.rewards(state, collided)
+        done = collided.any() or self.network.sim_time > self.episode_length
+        dones = np.full(self.num_envs, done)
+
+        infos = [{} for _ in range(self.num_envs)]
+        if done:
+            for i in range(self.num_envs):
+                infos[i]["terminal_observation"] = state[i].copy()
+                infos[i]["reason"] = "collision" if collided.any() else "time_limit"
+            self.network.reset()
+            state = self.get_state()
+        return state, rewards.astype(np.float32), dones, infos
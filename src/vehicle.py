@@ -9,34 +9,54 @@ class Veh:
         self.radius = CAR_RADIUS
         self.waiting_time = 0
         self.passed_intersection = False
+        # Ticks spent stopped, at a red light or behind another car, and how many times
+        # the car came to a stop
+        self.delay_ticks = 0
+        self.stops = 0
+        self.stopped = False
 
-    def move(self, cars: list['Veh']) -> None:
+    def progress(self) -> int:
+        """Position along the lane, increasing in the direction of travel"""
+        match self.direction:
+            case 0:
+                return self.x
+            case 1:
+                return -self.y
+            case 2:
+                return -self.x
+            case 3:
+                return self.y
+
+    def move(self, leader: 'Veh | None') -> bool:
         """Moves the car
         Direction 0: Car moves right
         Direction 1: Car moves down
         Direction 2: Car moves left
         Direction 3: Car moves up
-        Car stops if another car is in front of it
+        Car stops if the car in front of it (its leader in the lane) is too close, without
+        changing its speed so a car held by a red light stays held.
+        Returns whether the car spent the tick waiting.
         """
         stop_offset = 20
 
         # Stop if there is a car in front of the current one
-        for other_car in cars:
-            if self != other_car:
-                if self.direction == other_car.direction:
-                    if self.direction == 0 and other_car.x > self.x and (other_car.x - self.x) < stop_offset:
-                        self.speed = 0
-                        return
-                    elif self.direction == 2 and other_car.x < self.x and (self.x - other_car.x) < stop_offset:
-                        self.speed = 0
-                        return
-                    elif self.direction == 1 and other_car.y < self.y and (self.y - other_car.y) < stop_offset:
-                        self.speed = 0
-                        return
-                    elif self.direction == 3 and other_car.y > self.y and (other_car.y - self.y) < stop_offset:
-                        self.speed = 0
-                        return
-        
+        blocked = False
+        if leader is not None:
+            if self.direction == 0 and leader.x > self.x and (leader.x - self.x) < stop_offset:
+                blocked = True
+            elif self.direction == 2 and leader.x < self.x and (self.x - leader.x) < stop_offset:
+                blocked = True
+            elif self.direction == 1 and leader.y < self.y and (self.y - leader.y) < stop_offset:
+                blocked = True
+            elif self.direction == 3 and leader.y > self.y and (leader.y - self.y) < stop_offset:
+                blocked = True
+        if blocked:
+            self.delay_ticks += 1
+            if not self.stopped:
+                self.stops += 1
+                self.stopped = True
+            return False
+
         match self.direction:
             case 0:
                 self.x += self.speed
@@ -48,4 +68,11 @@ class Veh:
                 self.y += self.speed
 
         if self.speed == 0:
-            self.waiting_time += 1/60
\ No newline at end of file
+            self.delay_ticks += 1
+            if not self.stopped:
+                self.stops += 1
+                self.stopped = True
+            self.waiting_time += TICK_DURATION
+            return True
+        self.stopped = False
+        return False
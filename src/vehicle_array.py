@@ -0,0 +1,439 @@
+import numpy as np
+from config import *
+
+# Per-direction lookup tables, indexed by direction (see the lane geometry in config).
+# Positions along a lane are expressed as progress p = SIGN * coordinate so that every
+# car travels towards increasing p regardless of its direction.
+AXIS = np.array([0, 1, 0, 1])
+SIGN = np.array([1, -1, -1, 1])
+SPAWN_XY = np.array(SPAWN_POS)
+STEP_XY = np.array(DIRECTION_STEP)
+STOP_P = np.array(STOP_LINE)
+PASS_P = np.array(PASS_LINE)
+EXIT_P = np.array(EXIT_LINE)
+CONFLICT_START_P = np.array(CONFLICT_START)
+CONFLICT_END_P = np.array(CONFLICT_END)
+FOLLOW_DISTANCE = 20
+
+
+def blocked_by_leaders(lanes: np.ndarray, p: np.ndarray, speed: np.ndarray) -> np.ndarray:
+    """Cars held back by the car in front of them this tick, given each car's lane key,
+    progress and speed in spawn order.
+
+    Cars are moved as if front to back in each lane, so a car's leader has already
+    moved when it checks the gap in front of it. Most gaps decide the outcome on their
+    own; for the rest (a gap that only stays open if the leader moves, or a leader
+    level with the car) the car is blocked exactly when its leader is. Those are
+    resolved in one pass by forward-filling the nearest decided leader down the lane.
+    """
+    n = len(p)
+    # Front to back in each lane, the earlier spawned of two level cars in front
+    front = np.lexsort((-np.arange(n), p, lanes))[::-1]
+    lane = lanes[front]
+    pos = p[front]
+    has_leader = np.zeros(n, dtype=bool)
+    has_leader[1:] = lane[1:] == lane[:-1]
+    gap = np.zeros(n, dtype=np.int64)
+    gap[1:] = pos[:-1] - pos[1:]
+    lead_speed = np.zeros(n, dtype=np.int64)
+    lead_speed[1:] = speed[front[:-1]]
+
+    # A leader level with the car only counts as ahead once it has moved
+    level = gap == 0
+    blocked = has_leader & np.where(level, lead_speed > 0, gap + lead_speed < FOLLOW_DISTANCE)
+    follows = has_leader & np.where(level, lead_speed == 0, (gap < FOLLOW_DISTANCE) & ~blocked)
+    source = np.where(follows, 0, np.arange(n))
+    np.maximum.accumulate(source, out=source)
+    stopped = np.empty(n, dtype=bool)
+    stopped[front] = blocked[source]
+    return stopped
+
+
+def close_pairs(horizontal: np.ndarray, vertical: np.ndarray, group: np.ndarray,
+                x: np.ndarray, y: np.ndarray, reach: int) -> tuple[np.ndarray, np.ndarray]:
+    """Pairs of a horizontal and a vertical car (given as indices) from the same group that
+    are closer than reach.
+
+    Vertical cars are sorted by (group, y) so that each horizontal car only compares
+    squared distances with the cars of its own group within reach along y.
+    """
+    if len(horizontal) == 0 or len(vertical) == 0:
+        return horizontal[:0], vertical[:0]
+    y_min = int(y.min())
+    group_key = int(y.max()) - y_min + 2 * reach + 1
+    vertical_key = group[vertical] * group_key + y[vertical] - y_min
+    order = np.argsort(vertical_key)
+    vertical = vertical[order]
+    vertical_key = vertical_key[order]
+    horizontal_key = group[horizontal] * group_key + y[horizontal] - y_min
+    lo = np.searchsorted(vertical_key, horizontal_key - reach, side="right")
+    hi = np.searchsorted(vertical_key, horizontal_key + reach, side="left")
+    counts = hi - lo
+    total = int(counts.sum())
+    if total == 0:
+        return horizontal[:0], vertical[:0]
+    first = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+    h = np.repeat(horizontal, counts)
+    v = vertical[first + np.arange(total)]
+    dx = x[h] - x[v]
+    dy = y[h] - y[v]
+    hits = dx * dx + dy * dy < reach * reach
+    return h[hits], v[hits]
+
+
+class VehArray:
+    """Structure-of-arrays store for the cars of a TrafficSim.
+
+    Holds the same per-car state as vehicle.Veh in preallocated NumPy arrays, kept in
+    spawn order, and updates every car at once. Stepping a VehArray produces the same
+    trajectories as stepping the equivalent list of Veh objects.
+
+    Cars can belong to num_envs independent intersections, told apart by their env
+    index. Lights are then given as an array of shape (num_envs, 4) in direction order.
+
+    The queue count of every approach and the total waiting time of every intersection
+    are kept up to date as cars spawn, pass, wait and leave, so reading them is O(1).
+    """
+    FIELDS = ["_pos", "_env", "_direction", "_speed", "_waiting_time", "_passed_intersection",
+              "_delay_ticks", "_stops", "_stopped"]
+
+    def __init__(self, capacity: int = 256, num_envs: int = 1):
+        self.count = 0
+        self.num_envs = num_envs
+        self.radius = CAR_RADIUS
+        # Cars per intersection and direction that have not passed the intersection
+        self.queue_counts = np.zeros((num_envs, 4), dtype=np.int64)
+        # Summed waiting time of the cars of each intersection
+        self.waiting_totals = np.zeros(num_envs, dtype=np.float64)
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int) -> None:
+        n = self.count
+        old = {name: getattr(self, name, None) for name in self.FIELDS}
+        self.capacity = capacity
+        self._pos = np.zeros((capacity, 2), dtype=np.int64)
+        self._env = np.zeros(capacity, dtype=np.int64)
+        self._direction = np.zeros(capacity, dtype=np.int64)
+        self._speed = np.zeros(capacity, dtype=np.int64)
+        self._waiting_time = np.zeros(capacity, dtype=np.float64)
+        self._passed_intersection = np.zeros(capacity, dtype=bool)
+        self._delay_ticks = np.zeros(capacity, dtype=np.int64)
+        self._stops = np.zeros(capacity, dtype=np.int64)
+        self._stopped = np.zeros(capacity, dtype=bool)
+        for name, values in old.items():
+            if values is not None:
+                getattr(self, name)[:n] = values[:n]
+
+    def __len__(self) -> int:
+        return self.count
+
+    # Views over the live cars only
+    @property
+    def x(self) -> np.ndarray:
+        return self._pos[:self.count, 0]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self._pos[:self.count, 1]
+
+    @property
+    def env(self) -> np.ndarray:
+        return self._env[:self.count]
+
+    @property
+    def direction(self) -> np.ndarray:
+        return self._direction[:self.count]
+
+    @property
+    def speed(self) -> np.ndarray:
+        return self._speed[:self.count]
+
+    @property
+    def waiting_time(self) -> np.ndarray:
+        return self._waiting_time[:self.count]
+
+    @property
+    def passed_intersection(self) -> np.ndarray:
+        return self._passed_intersection[:self.count]
+
+    @property
+    def delay_ticks(self) -> np.ndarray:
+        return self._delay_ticks[:self.count]
+
+    @property
+    def stops(self) -> np.ndarray:
+        return self._stops[:self.count]
+
+    @property
+    def stopped(self) -> np.ndarray:
+        return self._stopped[:self.count]
+
+    def progress(self) -> np.ndarray:
+        n = self.count
+        d = self._direction[:n]
+        return SIGN[d] * self._pos[np.arange(n), AXIS[d]]
+
+    def spawn(self, direction: int, distance: int = 0, env: int = 0) -> None:
+        """Appends a new car distance pixels along the lane for the given direction"""
+        self.spawn_many(np.array([env]), np.array([direction]), distance)
+
+    def spawn_many(self, envs: np.ndarray, directions: np.ndarray, distance: int = 0) -> None:
+        """Appends one car per (env, direction) pair, in the order given"""
+        k = len(envs)
+        while self.count + k > self.capacity:
+            self._allocate(2 * self.capacity)
+        new = slice(self.count, self.count + k)
+        pos = SPAWN_XY[directions] + distance * STEP_XY[directions]
+        self._pos[new] = pos
+        self._env[new] = envs
+        self._direction[new] = directions
+        self._speed[new] = CAR_SPEED
+        self._waiting_time[new] = 0
+        self._delay_ticks[new] = 0
+        self._stops[new] = 0
+        self._stopped[new] = False
+        passed = SIGN[directions] * pos[np.arange(k), AXIS[directions]] >= PASS_P[directions]
+        self._passed_intersection[new] = passed
+        np.add.at(self.queue_counts, (envs[~passed], directions[~passed]), 1)
+        self.count += k
+
+    def remove(self, mask: np.ndarray) -> None:
+        """Drops the cars selected by mask, compacting the rest in place while preserving
+        spawn order
+        """
+        keep = ~mask
+        n = int(keep.sum())
+        if n == self.count:
+            return
+        queued = mask & ~self.passed_intersection
+        np.subtract.at(self.queue_counts, (self.env[queued], self.direction[queued]), 1)
+        self.waiting_totals -= np.bincount(self.env[mask], weights=self.waiting_time[mask], minlength=self.num_envs)
+        for name in self.FIELDS:
+            values = getattr(self, name)
+            values[:n] = values[:self.count][keep]
+        self.count = n
+
+    def clear(self, envs: np.ndarray | None = None) -> None:
+        """Removes every car, or only those of the intersections selected by the boolean
+        mask envs
+        """
+        if envs is None:
+            self.count = 0
+            self.queue_counts[:] = 0
+            self.waiting_totals[:] = 0
+        else:
+            self.remove(envs[self.env])
+            # Exact zeros rather than what is left after subtracting the waiting times
+            self.waiting_totals[envs] = 0
+
+    def set_cars(self, x, y, direction, speed, waiting_time, passed_intersection, env=0,
+                 delay_ticks=0, stops=0, stopped=False) -> None:
+        """Replaces every car with the given columns, recounting the queues and waiting
+        totals from them
+        """
+        n = len(x)
+        while n > self.capacity:
+            self._allocate(2 * self.capacity)
+        self.count = n
+        self._pos[:n, 0] = x
+        self._pos[:n, 1] = y
+        self._env[:n] = env
+        self._direction[:n] = direction
+        self._speed[:n] = speed
+        self._waiting_time[:n] = waiting_time
+        self._passed_intersection[:n] = passed_intersection
+        self._delay_ticks[:n] = delay_ticks
+        self._stops[:n] = stops
+        self._stopped[:n] = stopped
+        queued = ~self.passed_intersection
+        self.queue_counts[:] = 0
+        np.add.at(self.queue_counts, (self.env[queued], self.direction[queued]), 1)
+        self.waiting_totals[:] = np.bincount(self.env, weights=self.waiting_time, minlength=self.num_envs)
+
+    def _lights(self, traffic_lights) -> np.ndarray:
+        """Light states as an array of shape (num_envs, 4) in direction order"""
+        if isinstance(traffic_lights, dict):
+            return np.array([[traffic_lights[key] for key in LIGHT_KEYS]])
+        return traffic_lights
+
+    def _red_stops(self, traffic_lights) -> np.ndarray:
+        """Cars held by a red light: not past the intersection and beyond their light"""
+        d = self.direction
+        red = (self._lights(traffic_lights) == 0)[self.env, d]
+        return ~self.passed_intersection & red & (self.progress() > STOP_P[d])
+
+    def check_traffic(self, traffic_lights) -> None:
+        """Vectorized TrafficSim.check_traffic: stops cars at red lights and flags cars
+        that passed the intersection
+        """
+        stopped = self._red_stops(traffic_lights)
+        self.speed[:] = np.where(stopped, 0, CAR_SPEED)
+        self.update_passed(traffic_lights, stopped)
+
+    def update_passed(self, traffic_lights, stopped=None) -> None:
+        """Flags cars that are free to move and have reached the far side of the
+        intersection
+        """
+        if stopped is None:
+            stopped = self._red_stops(traffic_lights)
+        passing = ~stopped & ~self.passed_intersection & (self.progress() >= PASS_P[self.direction])
+        np.subtract.at(self.queue_counts, (self.env[passing], self.direction[passing]), 1)
+        self.passed_intersection[:] |= passing
+
+    def move(self) -> None:
+        """Vectorized Veh.move for every car, see blocked_by_leaders"""
+        if self.count == 0:
+            return
+        d = self.direction
+        speed = self.speed
+        blocked = blocked_by_leaders(self.env * 4 + d, self.progress(), speed)
+
+        # Blocked cars stop without accruing waiting time or changing their speed, just
+        # like Veh.move
+        moving = ~blocked
+        axis = AXIS[d]
+        rows = np.arange(self.count)
+        self._pos[rows[moving], axis[moving]] += SIGN[d[moving]] * speed[moving]
+        waiting = moving & (speed == 0)
+        self.waiting_time[waiting] += TICK_DURATION
+        self.waiting_totals += TICK_DURATION * np.bincount(self.env[waiting], minlength=self.num_envs)
+        self.stand(blocked | (speed == 0))
+
+    def stand(self, stopped: np.ndarray, ticks: int = 1) -> None:
+        """Adds ticks spent stopped to the delays of the stopped cars, and a stop to those
+        that were moving before, as Veh.move does
+        """
+        self.stops[:] += stopped & ~self.stopped
+        self.delay_ticks[:] += ticks * stopped
+        self.stopped[:] = stopped
+
+    def _quiet_motion(self, traffic_lights) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Speed each car would get from check_traffic, and whether it is blocked and held
+        waiting, for the next tick
+        """
+        held = self._red_stops(traffic_lights)
+        speed = np.where(held, 0, CAR_SPEED)
+        blocked = blocked_by_leaders(self.env * 4 + self.direction, self.progress(), speed)
+        return speed, blocked, held & ~blocked
+
+    def quiet_ticks(self, traffic_lights, limit: int) -> int:
+        """Number of the next ticks, up to limit, that change nothing but positions and
+        waiting times: no car reaches a red stop line, passes the intersection or leaves,
+        and no gap to a leader closes or opens enough to change how either car moves. Every
+        car then keeps its speed, so coast can apply those ticks at once.
+
+        Thresholds are counted conservatively, so a quiet stretch can end a tick early but
+        never late.
+        """
+        n = self.count
+        if n == 0 or limit <= 0:
+            return max(limit, 0)
+        d = self.direction
+        p = self.progress()
+        speed, blocked, _ = self._quiet_motion(traffic_lights)
+        v = np.where(blocked, 0, speed)
+        k = np.full(n, limit, dtype=np.int64)
+        moving = v > 0
+        approaching = ~self.passed_intersection
+        red = (self._lights(traffic_lights) == 0)[self.env, d]
+
+        # A moving car must stay short of a red stop line at the start of every tick
+        m = moving & approaching & red
+        k[m] = np.minimum(k[m], (STOP_P[d[m]] - p[m]) // CAR_SPEED + 1)
+        # and short of the pass line after every move. A car that is not held and
+        # already beyond it is flagged on the very next tick.
+        m = moving & approaching
+        k[m] = np.minimum(k[m], (PASS_P[d[m]] - 1 - p[m]) // CAR_SPEED)
+        k[approaching & ~moving & (speed > 0) & (p >= PASS_P[d])] = 0
+        m = moving
+        k[m] = np.minimum(k[m], (EXIT_P[d[m]] - p[m]) // CAR_SPEED)
+
+        # Gaps to leaders, front to back in each lane as in blocked_by_leaders
+        lanes = self.env * 4 + d
+        front = np.lexsort((-np.arange(n), p, lanes))[::-1]
+        follower = front[1:][lanes[front[1:]] == lanes[front[:-1]]]
+        leader = front[:-1][lanes[front[1:]] == lanes[front[:-1]]]
+        gap = p[leader] - p[follower]
+        rate = v[leader] - v[follower]
+        # How the follower moves changes when the gap crosses 20, 20 minus the leader's
+        # speed, or reaches 0 (level cars)
+        thresholds = np.stack([np.full_like(gap, FOLLOW_DISTANCE), FOLLOW_DISTANCE - speed[leader], np.ones_like(gap)])
+        closing = (rate < 0) & (gap >= thresholds)
+        opening = (rate > 0) & (gap < thresholds)
+        ticks = np.where(closing, (gap - thresholds) // CAR_SPEED + 1, np.where(opening, (thresholds - gap + 1) // CAR_SPEED, limit))
+        k[follower] = np.minimum(k[follower], ticks.min(axis=0))
+        return int(max(k.min(), 0))
+
+    def coast(self, ticks: int, traffic_lights) -> None:
+        """Applies ticks quiet ticks at once, see quiet_ticks: every car moves at its
+        current speed, held cars accrue waiting time and stopped cars delay
+        """
+        if self.count == 0:
+            return
+        speed, blocked, waiting = self._quiet_motion(traffic_lights)
+        self.speed[:] = speed
+        step = np.where(blocked, 0, speed)
+        d = self.direction
+        rows = np.arange(self.count)
+        self._pos[rows, AXIS[d]] += SIGN[d] * step * ticks
+        self.waiting_time[waiting] += ticks * TICK_DURATION
+        self.waiting_totals += ticks * TICK_DURATION * np.bincount(self.env[waiting], minlength=self.num_envs)
+        self.stand(step == 0, ticks)
+
+    def out_of_bounds(self) -> np.ndarray:
+        return self.progress() > EXIT_P[self.direction]
+
+    def remove_out_of_bounds(self) -> None:
+        """Vectorized TrafficSim.check_car_out_of_bounds over every car"""
+        self.remove(self.out_of_bounds())
+
+    def _collision_pairs(self) -> tuple[np.ndarray, np.ndarray]:
+        """Indices of the horizontal and vertical car of every colliding pair.
+
+        Only cars inside the conflict zone can collide, and opposite lanes are too far apart
+        to touch, so only horizontal cars in the zone are checked against vertical ones.
+        """
+        d = self.direction
+        p = self.progress()
+        in_zone = (p >= CONFLICT_START_P[d]) & (p <= CONFLICT_END_P[d])
+        horizontal = np.flatnonzero(in_zone & (d % 2 == 0))
+        vertical = np.flatnonzero(in_zone & (d % 2 == 1))
+        return close_pairs(horizontal, vertical, self.env, self.x, self.y, 2 * self.radius)
+
+    def find_collisions(self, first_only: bool = False) -> list[tuple[int, int]]:
+        """Index pairs of colliding cars from different directions. With first_only, stops
+        at the first pair found.
+        """
+        h, v = self._collision_pairs()
+        if first_only:
+            h, v = h[:1], v[:1]
+        return list(zip(h.tolist(), v.tolist()))
+
+    def check_collision(self) -> bool:
+        return bool(self.find_collisions(first_only=True))
+
+    def collided_envs(self) -> np.ndarray:
+        """Boolean mask of the intersections with at least one collision"""
+        collided = np.zeros(self.num_envs, dtype=bool)
+        collided[self.env[self._collision_pairs()[0]]] = True
+        return collided
+
+    def approach_counts(self) -> np.ndarray:
+        """Number of cars per intersection and direction that have not passed the
+        intersection, of shape (num_envs, 4). This is the live counter, not a copy.
+        """
+        return self.queue_counts
+
+    def queue_lengths(self) -> np.ndarray:
+        """Number of stopped cars per intersection and direction that have not passed the
+        intersection, of shape (num_envs, 4)
+        """
+        queued = self.stopped & ~self.passed_intersection
+        keys = self.env[queued] * 4 + self.direction[queued]
+        return np.bincount(keys, minlength=4 * self.num_envs).reshape(self.num_envs, 4)
+
+    def total_waiting_time(self) -> np.ndarray:
+        """Summed waiting time of the cars of each intersection. This is the live
+        counter, not a copy.
+        """
+        return self.waiting_totals